@@ -0,0 +1,192 @@
+# A compact, indexed binary format for intersect_maps save states.
+#
+# The checkpoint file is a fixed-size header followed by a sequence of framed records. Every frame
+# stores the record kind, the (n, i) pair it refers to, the payload length, and a CRC of the payload,
+# so a partially written tail (e.g., from a crash) can be detected and discarded. Changed features
+# are stored with their properties as JSON and their geometries as WKB.
+#
+# A sidecar index file (the checkpoint path plus ".idx") holds one fixed-size entry per record with
+# the record's kind, pair, and offset. That lets a reader find every record without parsing the
+# payloads; the geometries are only decoded when a record is actually requested.
+
+import json
+import os
+import struct
+import zlib
+
+import shapely.wkb
+
+import zoning
+
+MAGIC = b"ZMCKPT1\n"
+HEADER = struct.Struct("<8sQQ")
+FRAME = struct.Struct("<BIIII")
+INDEX_ENTRY = struct.Struct("<BIIQ")
+NULL_REGION = struct.Struct("<IIII")
+FEATURE_HEADER = struct.Struct("<II")
+
+NULL_REGION_RECORD = 0
+EMPTY_PAIR_RECORD = 1
+CHANGED_PAIR_RECORD = 2
+
+def index_path(path):
+    return "%s.idx" % path
+
+def is_checkpoint(path):
+    """Returns whether the file at path is a binary checkpoint (rather than a JSONL save state)"""
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def encode_feature(feature):
+    properties = json.dumps([feature.objectid, feature.zoning, feature.old_zoning]).encode("utf-8")
+    geometry = feature.geometry.wkb
+    return FEATURE_HEADER.pack(len(properties), len(geometry)) + properties + geometry
+
+def decode_feature(data, offset = 0):
+    """Returns the decoded feature and the offset of the end of its encoding"""
+    properties_length, geometry_length = FEATURE_HEADER.unpack_from(data, offset)
+    offset += FEATURE_HEADER.size
+    objectid, zoning_codes, old_zoning = json.loads(data[offset:offset + properties_length].decode("utf-8"))
+    offset += properties_length
+    geometry = shapely.wkb.loads(data[offset:offset + geometry_length])
+    offset += geometry_length
+    return zoning.ZoningFeature(objectid, zoning_codes, geometry, old_zoning), offset
+
+def encode_features(features):
+    encoded = []
+    for feature in features:
+        if feature is None:
+            encoded.append(b"\x00")
+        else:
+            encoded.append(b"\x01")
+            encoded.append(encode_feature(feature))
+    return b"".join(encoded)
+
+def decode_features(data):
+    features = []
+    offset = 0
+    while offset < len(data):
+        present = data[offset:offset + 1] == b"\x01"
+        offset += 1
+        if present:
+            feature, offset = decode_feature(data, offset)
+            features.append(feature)
+        else:
+            features.append(None)
+    return features
+
+def _read_frame(stream, offset):
+    """Returns (kind, n, i, payload) for the frame at offset, or None if it is truncated or corrupt"""
+    stream.seek(offset)
+    header = stream.read(FRAME.size)
+    if len(header) < FRAME.size:
+        return None
+    kind, n, i, length, crc = FRAME.unpack(header)
+    payload = stream.read(length)
+    if len(payload) < length or (zlib.crc32(payload) & 0xffffffff) != crc:
+        return None
+    return kind, n, i, payload
+
+class CheckpointReader(object):
+    def __init__(self, path, logger = None):
+        if logger is None:
+            logger = lambda m : None
+        self.path = path
+        self.stream = open(path, "rb")
+        magic, self.map1_len, self.map2_len = HEADER.unpack(self.stream.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not a checkpoint file" % path)
+        self.entries = self._load_index()
+        if self.entries:
+            kind, n, i, offset = self.entries[-1]
+            frame = _read_frame(self.stream, offset)
+            offset += FRAME.size + len(frame[3])
+        else:
+            offset = HEADER.size
+        # the index is flushed after the data, so there may be valid records past the last index entry
+        recovered = 0
+        while True:
+            frame = _read_frame(self.stream, offset)
+            if frame is None:
+                break
+            self.entries.append((frame[0], frame[1], frame[2], offset))
+            offset += FRAME.size + len(frame[3])
+            recovered += 1
+        if recovered:
+            logger("Recovered %d checkpoint records that were missing from the index\n" % recovered)
+        # a null region is always immediately followed by the changed pair that ended it,
+        # so a trailing null region means that the pair was never written
+        while self.entries and self.entries[-1][0] == NULL_REGION_RECORD:
+            offset = self.entries.pop()[3]
+        self.consistent_length = offset
+    def _load_index(self):
+        entries = []
+        if os.path.exists(index_path(self.path)):
+            with open(index_path(self.path), "rb") as f:
+                data = f.read()
+            for k in range(len(data) // INDEX_ENTRY.size):
+                entries.append(INDEX_ENTRY.unpack_from(data, k * INDEX_ENTRY.size))
+        # discard index entries that point to data that never made it to disk
+        while entries and _read_frame(self.stream, entries[-1][3]) is None:
+            entries.pop()
+        return entries
+    def close(self):
+        self.stream.close()
+    def last_index(self):
+        if not self.entries:
+            return None
+        kind, n, i, offset = self.entries[-1]
+        return [n, i]
+    def null_region(self, offset):
+        return NULL_REGION.unpack(_read_frame(self.stream, offset)[3])
+    def features(self, offset):
+        """Decodes the features recorded for a changed pair"""
+        return decode_features(_read_frame(self.stream, offset)[3])
+
+class CheckpointWriter(object):
+    """Appends records to a checkpoint file, first discarding any inconsistent tail left by an earlier run"""
+    def __init__(self, path):
+        self.path = path
+        self._pending_index = []
+        if os.path.exists(path) and os.path.getsize(path) >= HEADER.size:
+            reader = CheckpointReader(path)
+            entries = reader.entries
+            self.offset = reader.consistent_length
+            reader.close()
+            self.stream = open(path, "r+b")
+            self.stream.truncate(self.offset)
+            self.stream.seek(self.offset)
+            with open(index_path(path), "wb") as index:
+                index.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in entries))
+            self.has_header = True
+        else:
+            self.stream = open(path, "wb")
+            self.offset = 0
+            self.has_header = False
+        self.index = open(index_path(path), "ab")
+    def write_header(self, map1_len, map2_len):
+        self.stream.write(HEADER.pack(MAGIC, map1_len, map2_len))
+        self.offset = HEADER.size
+        self.has_header = True
+    def _write_record(self, kind, n, i, payload):
+        self.stream.write(FRAME.pack(kind, n, i, len(payload), zlib.crc32(payload) & 0xffffffff))
+        self.stream.write(payload)
+        self._pending_index.append(INDEX_ENTRY.pack(kind, n, i, self.offset))
+        self.offset += FRAME.size + len(payload)
+    def write_null_region(self, fromn, fromi, ton, toi):
+        self._write_record(NULL_REGION_RECORD, fromn, fromi, NULL_REGION.pack(fromn, fromi, ton, toi))
+    def write_pair(self, n, i, features):
+        if features is None:
+            self._write_record(EMPTY_PAIR_RECORD, n, i, b"")
+        else:
+            self._write_record(CHANGED_PAIR_RECORD, n, i, encode_features(features))
+    def flush(self):
+        # the data must be written before the index entries that point to it
+        self.stream.flush()
+        self.index.write(b"".join(self._pending_index))
+        self.index.flush()
+        self._pending_index = []
+    def close(self):
+        self.flush()
+        self.stream.close()
+        self.index.close()
@@ -0,0 +1,249 @@
+# A columnar binary format for zoning maps, so that programs that only need a few attributes of every feature (e.g.,
+# the zoning codes or OBJECTIDs) can read them without parsing, or even reading, the geometries.
+#
+# Like Parquet, the file is split into row groups, and every row group stores each of its columns contiguously:
+#   MAGIC
+#   for each row group, for each column: an array of ROWS + 1 little-endian int64 offsets, then the column's data
+#   for each row group: an array of ROWS x 4 little-endian float64 feature bounds (NaN for empty geometries)
+#   the metadata as JSON: the column names, and the row count, extent, and chunk positions of every row group
+#   FOOTER: the length of the metadata, then MAGIC
+# Every array starts at a multiple of eight bytes. Each GeoJSON property is a column whose values are stored as JSON
+# (a missing property has an empty value), and the geometries are a separate column of WKB. Files are memory-mapped,
+# so only the chunks that are actually read need to be resident, and the extent of each row group lets a reader skip
+# the groups that cannot intersect a bounding box.
+#
+# Conversion from GeoJSON keeps the properties (in their original order) and the geometries of the features. It is
+# lossless for the GeoJSON that this repository writes; coordinates are stored as doubles, so integer coordinates in
+# other GeoJSON are read back as floats.
+#
+# Usage: python columnar.py INPUT OUTPUT
+# converts a GeoJSON map to the columnar format, or a columnar map to GeoJSON.
+
+import bisect
+import json
+import mmap
+import struct
+
+import numpy
+from shapely.geometry import shape
+
+import featurestream
+import geojsonstream
+
+MAGIC = b"ZMCOLS1\n"
+FOOTER = struct.Struct("<Q8s")
+ROW_GROUP_SIZE = 16384
+FORMAT_VERSION = 1
+
+def is_columnar(source):
+    """Returns whether a file or buffer is a columnar map. Files that cannot seek (e.g., pipes) never are, since
+    checking them would consume their first bytes."""
+    if hasattr(source, "read"):
+        try:
+            position = source.tell()
+            magic = source.read(len(MAGIC))
+            source.seek(position)
+        except (IOError, ValueError):
+            return False
+        return magic == MAGIC
+    return source[:len(MAGIC)] == MAGIC
+
+class ColumnarWriter(object):
+    """Writes rows of GeoJSON properties and WKB geometries to a stream, which does not have to be seekable"""
+    def __init__(self, stream, row_group_size = ROW_GROUP_SIZE):
+        self.stream = stream
+        self.row_group_size = row_group_size
+        self.columns = []
+        self._column_set = set()
+        self.row_groups = []
+        self._rows = []
+        self.stream.write(MAGIC)
+        self.position = len(MAGIC)
+    def _write(self, data):
+        self.stream.write(data)
+        self.position += len(data)
+        if self.position % 8:
+            padding = 8 - self.position % 8
+            self.stream.write(b"\0" * padding)
+            self.position += padding
+    def _write_chunk(self, values):
+        offsets = numpy.zeros(len(values) + 1, dtype = "<i8")
+        offsets[1:] = numpy.cumsum([len(value) for value in values])
+        offsets_position = self.position
+        self._write(offsets.tostring())
+        data_position = self.position
+        data = b"".join(values)
+        self._write(data)
+        return [offsets_position, data_position, len(data)]
+    def append(self, properties, wkb, bounds):
+        """bounds is (minx, miny, maxx, maxy), or empty for an empty geometry"""
+        for name in properties:
+            if name not in self._column_set:
+                self._column_set.add(name)
+                self.columns.append(name)
+        self._rows.append((properties, wkb, bounds))
+        if len(self._rows) >= self.row_group_size:
+            self._flush()
+    def _flush(self):
+        if not self._rows:
+            return
+        group = {"rows":len(self._rows), "columns":{}}
+        for name in self.columns:
+            group["columns"][name] = self._write_chunk([json.dumps(properties[name]).encode("utf-8") if name in properties else b"" for properties, wkb, bounds in self._rows])
+        group["geometry"] = self._write_chunk([wkb for properties, wkb, bounds in self._rows])
+        bounds = numpy.array([b if b else (float("nan"),) * 4 for properties, wkb, b in self._rows], dtype = "<f8").reshape((len(self._rows), 4))
+        group["bounds"] = self.position
+        self._write(bounds.tostring())
+        if numpy.isnan(bounds[:,0]).all():
+            group["extent"] = None
+        else:
+            group["extent"] = [float(numpy.nanmin(bounds[:,0])), float(numpy.nanmin(bounds[:,1])), float(numpy.nanmax(bounds[:,2])), float(numpy.nanmax(bounds[:,3]))]
+        self.row_groups.append(group)
+        self._rows = []
+    def close(self):
+        self._flush()
+        metadata = json.dumps({"version":FORMAT_VERSION, "columns":self.columns, "row_groups":self.row_groups}).encode("utf-8")
+        self.stream.write(metadata)
+        self.stream.write(FOOTER.pack(len(metadata), MAGIC))
+
+def write_features(features, stream, row_group_size = ROW_GROUP_SIZE):
+    """Writes ZoningFeatures to stream as a columnar map"""
+    writer = ColumnarWriter(stream, row_group_size = row_group_size)
+    for feature in features:
+        writer.append(feature.to_geo(include_geometry = False)["properties"], feature.wkb(), feature.geometry.bounds)
+    writer.close()
+
+class ColumnarReader(object):
+    """Reads a columnar map from a file (which is memory-mapped) or a buffer.
+    Indexing the reader returns a feature's properties and WKB geometry, and raw() returns it as GeoJSON text."""
+    def __init__(self, source):
+        self._mmap = None
+        if hasattr(source, "fileno"):
+            try:
+                self._mmap = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+                self.data = self._mmap
+            except (ValueError, EnvironmentError):
+                self.data = source.read()
+        elif hasattr(source, "read"):
+            self.data = source.read()
+        else:
+            self.data = source
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a columnar map")
+        metadata_length, magic = FOOTER.unpack_from(self.data, len(self.data) - FOOTER.size)
+        if magic != MAGIC:
+            raise ValueError("The columnar map is truncated")
+        end = len(self.data) - FOOTER.size
+        metadata = json.loads(self.data[end - metadata_length:end].decode("utf-8"))
+        if metadata["version"] != FORMAT_VERSION:
+            raise ValueError("Unsupported columnar map version %s" % metadata["version"])
+        self.columns = metadata["columns"]
+        self.row_groups = metadata["row_groups"]
+        self._starts = [0]
+        for group in self.row_groups:
+            self._starts.append(self._starts[-1] + group["rows"])
+        # the offsets of the most recently read row group, as lists, since indexing numpy arrays is comparatively slow
+        self._cached_group = None
+        self._cached_offsets = {}
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+    def __len__(self):
+        return self._starts[-1]
+    def group_rows(self, group):
+        """Returns the range of the rows in a row group"""
+        return range(self._starts[group], self._starts[group + 1])
+    def select(self, bounds = None):
+        """Returns the indexes of the row groups that might have features intersecting bounds (or all of them)"""
+        if bounds is None:
+            return list(range(len(self.row_groups)))
+        minx, miny, maxx, maxy = bounds
+        return [g for g, group in enumerate(self.row_groups) if group["extent"] is not None and group["extent"][0] <= maxx and minx <= group["extent"][2] and group["extent"][1] <= maxy and miny <= group["extent"][3]]
+    def _offsets(self, group, chunk):
+        if self._cached_group != group:
+            self._cached_group = group
+            self._cached_offsets = {}
+        key = chunk[0]
+        if key not in self._cached_offsets:
+            self._cached_offsets[key] = numpy.frombuffer(self.data, dtype = "<i8", count = self.row_groups[group]["rows"] + 1, offset = chunk[0]).tolist()
+        return self._cached_offsets[key]
+    def _value(self, group, chunk, row):
+        offsets = self._offsets(group, chunk)
+        return self.data[chunk[1] + offsets[row]:chunk[1] + offsets[row + 1]]
+    def _locate(self, key):
+        if key < 0 or key >= len(self):
+            raise IndexError(key)
+        group = bisect.bisect_right(self._starts, key) - 1
+        return group, key - self._starts[group]
+    def column(self, name, groups = None, default = None):
+        """Yields the value of one property of every feature (in the given row groups), without reading any of the
+        other columns. Features without the property yield default."""
+        if groups is None:
+            groups = range(len(self.row_groups))
+        for g in groups:
+            chunk = self.row_groups[g]["columns"].get(name)
+            for row in range(self.row_groups[g]["rows"]):
+                value = b"" if chunk is None else self._value(g, chunk, row)
+                yield json.loads(value.decode("utf-8")) if value else default
+    def bounds(self, groups = None):
+        """Returns an array of the bounds of every feature (in the given row groups), NaN for empty geometries"""
+        if groups is None:
+            groups = range(len(self.row_groups))
+        arrays = [numpy.frombuffer(self.data, dtype = "<f8", count = self.row_groups[g]["rows"] * 4, offset = self.row_groups[g]["bounds"]).reshape((self.row_groups[g]["rows"], 4)) for g in groups]
+        if not arrays:
+            return numpy.empty((0, 4))
+        return numpy.concatenate(arrays)
+    def properties(self, key, columns = None):
+        """Returns the properties of a feature (or only the given properties of it)"""
+        group, row = self._locate(key)
+        chunks = self.row_groups[group]["columns"]
+        properties = {}
+        for name in self.columns if columns is None else columns:
+            if name in chunks:
+                value = self._value(group, chunks[name], row)
+                if value:
+                    properties[name] = json.loads(value.decode("utf-8"))
+        return properties
+    def wkb(self, key):
+        group, row = self._locate(key)
+        return self._value(group, self.row_groups[group]["geometry"], row)
+    def __getitem__(self, key):
+        return self.properties(key), self.wkb(key)
+    def __iter__(self):
+        for key in range(len(self)):
+            yield self[key]
+    def raw(self, key):
+        """Returns the GeoJSON text of a feature"""
+        return geojsonstream.wkb_feature_json(*self[key])
+
+def from_geojson(instream, outstream, row_group_size = ROW_GROUP_SIZE):
+    """Converts a GeoJSON feature collection to a columnar map"""
+    writer = ColumnarWriter(outstream, row_group_size = row_group_size)
+    features = featurestream.FeatureStream(instream)
+    for geojson in features:
+        geometry = shape(geojson["geometry"])
+        writer.append(geojson["properties"], geometry.wkb, geometry.bounds)
+    features.close()
+    writer.close()
+
+def to_geojson(instream, outstream):
+    """Converts a columnar map to a GeoJSON feature collection"""
+    reader = ColumnarReader(instream)
+    outstream.write('{"type": "FeatureCollection", "features": [')
+    for key in range(len(reader)):
+        if key > 0:
+            outstream.write(", ")
+        outstream.write(reader.raw(key))
+    outstream.write("]}")
+    reader.close()
+
+if __name__ == "__main__":
+    import sys
+
+    with open(sys.argv[1], "rb") as instream:
+        with open(sys.argv[2], "wb") as outstream:
+            if is_columnar(instream):
+                to_geojson(instream, outstream)
+            else:
+                from_geojson(instream, outstream)
@@ -1,11 +1,17 @@
 from fastkml import kml
 import fastkml
-import shapely
+import json
+import multiprocessing
+import numpy
 import sys
 
+import featurecache
+import functools
+import kmlstream
+import kmltiles
+from metrics import Collected, METRICS
 import philly
 import progress
-import septa
 import zoning
 
 class MappingMode:
@@ -40,37 +46,49 @@ class MaxDistrict(object):
             color = "%s0000ff" % hex(int(min((1.0 - (self.new_max / self.old_max)), 1.0) * 128 + 0.5))[2:]
         return "%s => %s (%s)" % (self.old_max, self.new_max, change), color
     
+def maximum_residency(feature, district, sqft):
+    return district.resident_bounds(sqft)[1]
+
+def maximum_sqft(feature, district, sqft):
+    return district.estimate_maximum_sqft(sqft)
+
 class MaxValueMetric(object):
     def __init__(self, name, value_function):
         self.name = name
         self.value_function = value_function
         self.old_value = 0
         self.new_value = 0
+        self.totals = []
     def new_district(self, *args):
         return MaxDistrict(*args, value_function = self.value_function)
+    def _add(self, old_max, new_max):
+        self.old_value += old_max
+        self.new_value += new_max
+        self.totals.append((old_max, new_max))
     def add_district(self, district):
         if district.values:
-            self.old_value += district.old_max
-            self.new_value += district.new_max
+            self._add(district.old_max, district.new_max)
             return True
         return False
+    def partial(self):
+        """Returns an empty metric with the same configuration, whose state can later be merged into this one"""
+        return MaxValueMetric(self.name, self.value_function)
+    def state(self):
+        return self.totals
+    def merge(self, state):
+        # the totals are re-accumulated one district at a time so they are identical to those of a serial run
+        for old_max, new_max in state:
+            self._add(old_max, new_max)
     def finalize(self):
         sys.stderr.write(" Pre-2012 %s: %s\n" % (self.name, self.old_value))
         sys.stderr.write("Post-2012 %s: %s\n" % (self.name, self.new_value))
 
 class BuiltResidentialCapacity(object):
-    def __init__(self, feature, district, sqft, compiled_data):
-        self.points, self.data, self.kdtree = compiled_data
+    def __init__(self, feature, district, sqft, join):
         self.feature = feature
         self.district = district
         self.sqft = sqft
-        self.feature_value = 0.0
-        self.feature_livable_area = 0.0
-        self.taxable_building = 0.0
-        for i in feature.find_contained_points(self.points, self.kdtree):
-            self.feature_value += self.data[i].market_value
-            self.feature_livable_area += self.data[i].total_livable_area
-            self.taxable_building += self.data[i].taxable_building
+        self.feature_value, self.feature_livable_area, self.taxable_building = join.contained_totals(feature)
         self.value = district.resident_bounds(sqft)[1]
         if self.value == 0:
             self.value = 1.0
@@ -98,141 +116,345 @@ class UnrealizedTaxRevenue(BuiltResidentialCapacity):
         return unralized, color
     
 class CurrentValueMetric(object):
-    def __init__(self, name, metric_class, compiled_data):
+    def __init__(self, name, metric_class, join):
         self.name = name
         self.metric_class = metric_class
         self.values = []
-        self.compiled_data = compiled_data
+        self.join = join
     def new_district(self, *args):
-        metric = self.metric_class(*args, compiled_data = self.compiled_data)
+        metric = self.metric_class(*args, join = self.join)
         self.values.append(metric.value)
         return metric
     def add_district(self, district):
         return True
+    def partial(self):
+        """Returns an empty metric with the same configuration, whose state can later be merged into this one"""
+        return CurrentValueMetric(self.name, self.metric_class, self.join)
+    def state(self):
+        return self.values
+    def merge(self, state):
+        self.values.extend(state)
     def finalize(self):
         sys.stderr.write("Average %s: %.2f\n" % (self.name, float(sum(self.values))/float(len(self.values))))
         
-def zoning_data(zoning_map):
-    metrics = (
-        MaxValueMetric("maximum residency", lambda feature, district, sqft : district.resident_bounds(sqft)[1]),
-        MaxValueMetric("maximum sqft.", lambda feature, district, sqft : district.estimate_maximum_sqft(sqft))
-    )
+RAW_METRICS = (
+    ("maximum residency", lambda rows, sqft : philly.ZONING_TABLES.resident_bounds(rows, sqft)[1]),
+    ("maximum sqft.", philly.ZONING_TABLES.estimate_maximum_sqft)
+)
+
+class ZoningColumns(object):
+    """The columns of every zoning feature that has both a current and a pre-2012 district"""
+    def __init__(self):
+        self.new_zoning = []
+        self.old_zoning = []
+        self.new_rows = []
+        self.old_rows = []
+        self.old_counts = []
+        self.lot_sqft = []
+        self.transit_distance = []
+    def __len__(self):
+        return len(self.new_zoning)
+
+    def extend(self, other):
+        self.new_zoning.extend(other.new_zoning)
+        self.old_zoning.extend(other.old_zoning)
+        self.new_rows.extend(other.new_rows)
+        self.old_rows.extend(other.old_rows)
+        self.old_counts.extend(other.old_counts)
+        self.lot_sqft.extend(other.lot_sqft)
+        self.transit_distance.extend(other.transit_distance)
+
+CHUNK_SIZE = 256
+
+def _chunks(zoning_map, chunk_size):
+    """Yields the index of the first feature and the raw GeoJSON of the map's features, chunk_size features at a time"""
+    for start in range(0, len(zoning_map), chunk_size):
+        yield start, [zoning_map.raw(i) for i in range(start, min(start + chunk_size, len(zoning_map)))]
+
+def _parse_chunk(chunk):
+    start, raws = chunk
+    features = []
+    for i, raw in enumerate(raws):
+        feature = zoning.parse_feature(json.loads(raw))
+        if _worker_derived is not None:
+            _worker_derived.apply(start + i, feature)
+        features.append(feature)
+    return features
+
+_worker_metric = None
+_worker_derived = None
+
+def _init_worker(metric, derived):
+    global _worker_metric, _worker_derived
+    _worker_metric = metric
+    _worker_derived = derived
+
+def map_chunks(function, zoning_map, workers, metric = None, chunk_size = CHUNK_SIZE):
+    """Applies function to chunks of the map's raw features in a pool of worker processes, yielding the results in
+    the order of the chunks. metric (which must be picklable) is available to the workers as _worker_metric."""
+    pool = multiprocessing.Pool(workers, _init_worker, (metric, zoning_map.derived))
+    try:
+        for result, snapshot in pool.imap(Collected(function), _chunks(zoning_map, chunk_size)):
+            METRICS.merge(snapshot)
+            yield result
+    finally:
+        pool.terminate()
+
+def add_columns(columns, feature):
+    """Adds the columns of a feature (whose area has already been calculated) to columns, if it has both a current and a known pre-2012 district"""
+    fzoning = feature.zoning_code()
+    if fzoning not in philly.ZONING:
+        return
+    elif not feature.old_zoning:
+        return
+    old_rows = [philly.ZONING_TABLES.rows[z[0]] for z in feature.old_zoning if z[0] in philly.ZONING]
+    if not old_rows:
+        return
+    columns.new_zoning.append(fzoning)
+    columns.old_zoning.append(feature.old_zoning_description())
+    columns.new_rows.append(philly.ZONING_TABLES.rows[fzoning])
+    columns.old_rows.extend(old_rows)
+    columns.old_counts.append(len(old_rows))
+    columns.lot_sqft.append(feature.lot_sqft())
+    columns.transit_distance.append(feature.transit_distance())
+
+def _add_columns(columns, features, estimator = None):
+    for feature in zoning.with_areas(features):
+        if estimator is not None:
+            estimator.increment()
+        METRICS.count("density.features")
+        with METRICS.timer("density.columns"):
+            add_columns(columns, feature)
+
+def _columns_chunk(chunk):
+    columns = ZoningColumns()
+    _add_columns(columns, _parse_chunk(chunk))
+    return len(chunk[1]), columns
+
+def zoning_columns(zoning_map, workers = 1):
+    columns = ZoningColumns()
     estimator = progress.TimeEstimator(None, 0, len(zoning_map), precision = 1)
-    yield tuple(["New Zoning", "Old Zoning"] + reduce(lambda x, y : x + y, map(lambda m : ["New " + m.name, "Old " + m.name], metrics)) + ["Distance to Closest Rapid Transit (meters)"])
-    for feature in zoning_map:
-        estimator.increment()
-        fzoning = feature.zoning
-        while type(fzoning) == list and len(fzoning) == 1:
-            fzoning = fzoning[0]
-        fzoning = str(fzoning)
-        if fzoning not in philly.ZONING:
-            continue
-        elif not feature.old_zoning:
-            continue
-        zonings = []
-        old_zoning = None
-        lot_sqft = zoning.square_meters_to_square_feet(feature.area())
-        ret = [fzoning]
-        for metric in metrics:
-            district = metric.new_district(feature, philly.ZONING[fzoning], lot_sqft)
-            for z in feature.old_zoning:
-                if old_zoning is None:
-                    zonings.append(' '.join(z))
-                if z[0] in philly.ZONING:
-                    district.add(philly.ZONING[z[0]])
-            if old_zoning is None:
-                old_zoning = " and ".join(zonings)
-                ret.append(old_zoning)
-            m = metric.add_district(district)
-            if not m:
-                ret = None
-                break
-            ret.append(district.new_max)
-            ret.append(district.old_max)
-        if ret is not None:
-            ret.append(min(map(lambda prt : feature.distance_to(prt[0], prt[1]), septa.PHILLY_RAPID_TRANSIT)))
-            yield tuple(ret)
+    if workers > 1:
+        for num_features, chunk_columns in map_chunks(_columns_chunk, zoning_map, workers):
+            columns.extend(chunk_columns)
+            estimator.increment(num_features)
+    else:
+        _add_columns(columns, zoning_map, estimator)
+    return columns
+
+def zoning_data(zoning_map, workers = 1):
+    # the metrics only accumulate the totals here; their values are calculated for all features at once
+    metrics = tuple(MaxValueMetric(name, None) for name, value_function in RAW_METRICS)
+    yield column_header(metrics)
+    for row in column_rows(zoning_columns(zoning_map, workers), metrics):
+        yield row
     for metric in metrics:
         metric.finalize()
-        
-def map_to_kml(zoning_map, metric = None):
+
+def column_header(metrics):
+    return tuple(["New Zoning", "Old Zoning"] + reduce(lambda x, y : x + y, map(lambda m : ["New " + m.name, "Old " + m.name], metrics)) + ["Distance to Closest Rapid Transit (meters)"])
+
+def column_rows(columns, metrics):
+    """Calculates the RAW_METRICS of every feature in columns at once, returning the rows of the raw CSV
+    and adding the totals to the corresponding metrics"""
+    data = [columns.new_zoning, columns.old_zoning]
+    if columns:
+        lot_sqft = numpy.array(columns.lot_sqft)
+        new_rows = numpy.array(columns.new_rows)
+        old_rows = numpy.array(columns.old_rows)
+        old_counts = numpy.array(columns.old_counts)
+        old_lot_sqft = numpy.repeat(lot_sqft, old_counts)
+        # the offset of each feature's first old district
+        old_starts = numpy.cumsum(old_counts) - old_counts
+        for metric, (name, value_function) in zip(metrics, RAW_METRICS):
+            new_max = value_function(new_rows, lot_sqft).tolist()
+            old_max = numpy.maximum.reduceat(value_function(old_rows, old_lot_sqft), old_starts).tolist()
+            metric.new_value += sum(new_max)
+            metric.old_value += sum(old_max)
+            data.append(new_max)
+            data.append(old_max)
+    else:
+        data.extend([] for metric in metrics for value in ("new", "old"))
+    data.append(columns.transit_distance)
+    return zip(*data)
+
+def _alpha_colors(suffix):
+    return ["%s%s" % (hex(alpha)[2:], suffix) for alpha in range(129)]
+
+# every color that MaxDistrict and BuiltResidentialCapacity placemarks can have
+PLACEMARK_COLORS = ["ff00ff00"] + _alpha_colors("00ff00") + _alpha_colors("0000ff")
+
+def feature_placemarks(feature, metric):
+    """Yields the placemarks of a feature (whose area has already been calculated), adding it to the metric"""
+    fzoning = feature.zoning_code()
+    if fzoning not in philly.ZONING:
+        return
+    elif not feature.old_zoning:
+        return
+    lot_sqft = feature.lot_sqft()
+    district = metric.new_district(feature, philly.ZONING[fzoning], lot_sqft)
+    for z in feature.old_zoning:
+        if z[0] in philly.ZONING:
+            district.add(philly.ZONING[z[0]])
+    if not metric.add_district(district):
+        return
+    message, color = district.get_placemark()
+    if message is not None:
+        for poly in feature.polygons():
+            yield str(feature.objectid), "%s => %s" % (feature.old_zoning_description(), fzoning), "%d sqft.; %s %s" % (int(lot_sqft + 0.5), metric.name, message), color, poly
+
+def _placemarks(features, metric):
+    for feature in zoning.with_areas(features):
+        METRICS.count("density.features")
+        with METRICS.timer("density.placemarks"):
+            placemarks = list(feature_placemarks(feature, metric))
+        for placemark in placemarks:
+            yield placemark
+
+def _placemarks_chunk(chunk):
+    metric = _worker_metric.partial()
+    placemarks = list(_placemarks(_parse_chunk(chunk), metric))
+    return placemarks, metric.state()
+
+def kml_placemarks(zoning_map, metric = None, workers = 1):
+    """Yields the (id, name, description, color, polygon) of every placemark in the density map.
+    With more than one worker, the features are processed in chunks by a process pool, and the workers' partial
+    metric totals are merged in the original feature order."""
     if metric is None:
-        metric = MaxValueMetric("maximum residency", lambda feature, district, sqft : district.resident_bounds(sqft)[1])
+        metric = MaxValueMetric("maximum residency", maximum_residency)
+    if workers > 1:
+        for placemarks, state in map_chunks(_placemarks_chunk, zoning_map, workers, metric = metric):
+            metric.merge(state)
+            for placemark in placemarks:
+                yield placemark
+    else:
+        for placemark in _placemarks(zoning_map, metric):
+            yield placemark
+    metric.finalize()
+
+def map_to_kml(zoning_map, metric = None):
     k = kml.KML()
     ns = '{http://www.opengis.net/kml/2.2}'
     d = kml.Document(ns, 'PHL Zoning Density Changes', 'Philadelphia Residential Zoning Density Changes 2012 to 2017', 'A map of the density changes between current (2017) zoning plots and the previous (Pre-2012) classifications.')
     k.append(d)
     f = kml.Folder(ns, 'PHL Zoning Density', 'Philadelphia Zoning Density', 'Changes to Philadelphia zoning density from 2012 to 2017')
     d.append(f)
-    for feature in zoning_map:
-        fzoning = feature.zoning
-        while type(fzoning) == list and len(fzoning) == 1:
-            fzoning = fzoning[0]
-        fzoning = str(fzoning)
-        if fzoning not in philly.ZONING:
-            continue
-        elif not feature.old_zoning:
-            continue
-        zonings = []
-        lot_sqft = zoning.square_meters_to_square_feet(feature.area())
-        district = metric.new_district(feature, philly.ZONING[fzoning], lot_sqft)
-        for z in feature.old_zoning:
-            zonings.append(' '.join(z))
-            if z[0] in philly.ZONING:
-                district.add(philly.ZONING[z[0]])
-        old_zoning = " and ".join(zonings)
-        if not metric.add_district(district):
-            continue
-        if feature.geometry.geom_type == "Polygon":
-            polygons = [feature.geometry]
-        else:
-            allparts = [p.buffer(0) for p in feature.geometry]
-            polygons = [shapely.ops.cascaded_union(allparts)]
-        message, color = district.get_placemark()
-        if message is not None:
-            for poly in polygons:
-                p = kml.Placemark(ns, str(feature.objectid), "%s => %s" % (old_zoning, fzoning), "%d sqft.; %s %s" % (int(lot_sqft + 0.5), metric.name, message))
-                p.append_style(fastkml.styles.Style(ns=ns, styles=[fastkml.styles.PolyStyle(ns=ns, color=color, fill=1, outline=0)]))
-                p.geometry = poly
-                f.append(p)
-    metric.finalize()
+    for placemark_id, name, description, color, poly in kml_placemarks(zoning_map, metric):
+        p = kml.Placemark(ns, placemark_id, name, description)
+        p.append_style(fastkml.styles.Style(ns=ns, styles=[fastkml.styles.PolyStyle(ns=ns, color=color, fill=1, outline=0)]))
+        p.geometry = poly
+        f.append(p)
     return k    
 
-if __name__ == "__main__":
-    import sys
+class KMLSink(object):
+    """Writes the density KML placemarks of features to outstream as they are added.
+    writer_class may instead be kmltiles.TiledKMLWriter, in which case outstream is the directory of the tiles."""
+    def __init__(self, outstream, metric = None, writer_class = kmlstream.KMLWriter):
+        if metric is None:
+            metric = MaxValueMetric("maximum residency", maximum_residency)
+        self.metric = metric
+        self.writer = writer_class(outstream, 'PHL Zoning Density Changes', 'Philadelphia Residential Zoning Density Changes 2012 to 2017', 'A map of the density changes between current (2017) zoning plots and the previous (Pre-2012) classifications.')
+        for color in PLACEMARK_COLORS:
+            self.writer.declare_style(color, fill = 1, outline = 0)
+        self.writer.begin_folder('PHL Zoning Density', 'Philadelphia Zoning Density', 'Changes to Philadelphia zoning density from 2012 to 2017')
+    def add_placemarks(self, placemarks):
+        with METRICS.timer("density.kml_write"):
+            for placemark_id, name, description, color, poly in placemarks:
+                self.writer.add_placemark(placemark_id, name, description, poly, color = color, fill = 1, outline = 0)
+    def add(self, feature):
+        METRICS.count("density.features")
+        with METRICS.timer("density.placemarks"):
+            placemarks = list(feature_placemarks(feature, self.metric))
+        self.add_placemarks(placemarks)
+    def close(self):
+        self.writer.end_folder()
+        self.writer.close()
+        self.metric.finalize()
 
-    metric = None
-    path = None
-    is_raw = False
+class RawSink(object):
+    """Collects the columns of features as they are added, and writes the raw CSV when closed"""
+    def __init__(self, outstream):
+        import csv
+        self.csvwriter = csv.writer(outstream, delimiter=',')
+        self.columns = ZoningColumns()
+    def add(self, feature):
+        METRICS.count("density.features")
+        with METRICS.timer("density.columns"):
+            add_columns(self.columns, feature)
+    def close(self):
+        metrics = tuple(MaxValueMetric(name, None) for name, value_function in RAW_METRICS)
+        self.csvwriter.writerow(column_header(metrics))
+        self.csvwriter.writerows(column_rows(self.columns, metrics))
+        for metric in metrics:
+            metric.finalize()
 
-    if sys.argv[1] == '-sqft':
-        metric = MaxValueMetric("maximum sqft.", lambda feature, district, sqft : district.estimate_maximum_sqft(sqft))
-        path = sys.argv[2]
-    elif sys.argv[1] == '-residency':
-        path = sys.argv[2]
-    elif sys.argv[1] == '-current-residency':
-        path = sys.argv[2]
+def write_kml(zoning_map, outstream, metric = None, workers = 1, writer_class = kmlstream.KMLWriter):
+    """Like map_to_kml, but writes each placemark to outstream as soon as its feature is processed"""
+    sink = KMLSink(outstream, metric, writer_class = writer_class)
+    if workers > 1:
+        for placemarks, state in map_chunks(_placemarks_chunk, zoning_map, workers, metric = sink.metric):
+            sink.metric.merge(state)
+            sink.add_placemarks(placemarks)
+            METRICS.maybe_export()
+    else:
+        for feature in zoning.with_areas(zoning_map):
+            sink.add(feature)
+            METRICS.maybe_export()
+    sink.close()
 
+def make_metric(mode, join = None):
+    """Returns the metric for a command line mode (None for the default residency metric).
+    The property join for the -current-residency and -tax modes is loaded if it is not provided."""
+    if mode in ('-current-residency', '-tax') and join is None:
         import properties
+        join = properties.PropertyJoin(properties.compile_data())
+    if mode == '-sqft':
+        return MaxValueMetric("maximum sqft.", maximum_sqft)
+    elif mode == '-current-residency':
+        return CurrentValueMetric("built residential capacity", BuiltResidentialCapacity, join)
+    elif mode == '-tax':
+        return CurrentValueMetric("unrealized tax revenue", UnrealizedTaxRevenue, join)
+    return None
 
-        metric = CurrentValueMetric("built residential capacity", BuiltResidentialCapacity, properties.compile_data())
-    elif sys.argv[1] == '-tax':
-        path = sys.argv[2]
+if __name__ == "__main__":
+    import sys
 
-        import properties
+    import metrics
+
+    args = metrics.configure(sys.argv[1:])
+    workers = 1
+    if "--workers" in args:
+        i = args.index("--workers")
+        workers = int(args[i + 1])
+        del args[i:i + 2]
+
+    # --tiles DIRECTORY writes a pyramid of KML tiles (see kmltiles) instead of a single KML document to stdout
+    outstream = sys.stdout
+    writer_class = kmlstream.KMLWriter
+    if "--tiles" in args:
+        i = args.index("--tiles")
+        outstream = args[i + 1]
+        writer_class = functools.partial(kmltiles.TiledKMLWriter, workers = workers)
+        del args[i:i + 2]
 
-        metric = CurrentValueMetric("unrealized tax revenue", UnrealizedTaxRevenue, properties.compile_data())
-    elif sys.argv[1] == '-raw':
-        path = sys.argv[2]
+    metric = None
+    path = None
+    is_raw = False
+
+    if args[0] == '-raw':
+        path = args[1]
         is_raw = True
+    elif args[0] in ('-sqft', '-residency', '-current-residency', '-tax'):
+        path = args[1]
+        metric = make_metric(args[0])
     else:
-        path = sys.argv[1]
-    
+        path = args[0]
+
+    derived = featurecache.load(path, logger = sys.stderr.write)
     with open(path, 'r') as f:
         if is_raw:
             import csv
             csvwriter = csv.writer(sys.stdout, delimiter=',')
-            for data in zoning_data(zoning.ZoningMap(f)):
-                csvwriter.writerow(data)
+            csvwriter.writerows(zoning_data(zoning.ZoningMap(f, streaming = True, derived = derived), workers = workers))
         else:
-            print map_to_kml(zoning.ZoningMap(f), metric = metric).to_string(prettyprint=True)
+            write_kml(zoning.ZoningMap(f, streaming = True, derived = derived), outstream, metric = metric, workers = workers, writer_class = writer_class)
@@ -0,0 +1,89 @@
+# An on-disk cache of the values that every output derives from the features of a zoning map, so that re-runs over
+# the same map can skip the geometry work.
+#
+# The cache is a structured NumPy array with one row per feature (in map order), stored next to the map and
+# memory-mapped when it is loaded. Rows are matched to features by position rather than by OBJECTID, since the
+# features of an intersected map share the OBJECTIDs of the features they were split from. The cache is keyed on a
+# hash of the map's contents, so any change to the map (including reordering it) invalidates it. Values that could not be calculated (e.g., for empty geometries) are stored as NaN.
+
+import hashlib
+import json
+import math
+import os
+
+import numpy
+
+import zoning
+
+CACHE_VERSION = 1
+COLUMNS = (("area", numpy.float64), ("transit_distance", numpy.float64))
+
+def cache_path(path):
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, ".%s.derived.npy" % filename)
+
+def content_hash(path, block_size = 1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+class DerivedFeatures(object):
+    """The cached values of every feature in a map, which ZoningMap fills in as features are parsed"""
+    def __init__(self, table):
+        self.table = table
+        self._areas = table["area"].tolist()
+        self._distances = table["transit_distance"].tolist()
+    def __len__(self):
+        return len(self.table)
+    def apply(self, key, feature):
+        if key >= len(self):
+            return
+        if not math.isnan(self._areas[key]):
+            feature._area = self._areas[key]
+        if not math.isnan(self._distances[key]):
+            feature._transit_distance = self._distances[key]
+
+def derive(zoning_map):
+    """Calculates the derived values of every feature in the map"""
+    table = numpy.empty(len(zoning_map), dtype=list(COLUMNS))
+    for i, feature in enumerate(zoning.with_areas(zoning_map)):
+        if feature.geometry.is_empty:
+            table["area"][i] = float("nan")
+            table["transit_distance"][i] = float("nan")
+        else:
+            table["area"][i] = feature.area()
+            table["transit_distance"][i] = feature.transit_distance()
+    return table
+
+def load(path, logger = None):
+    """Returns the DerivedFeatures of the zoning map at path, calculating and caching them if the map has changed
+    since they were last cached (or if they never were)"""
+    if logger is None:
+        logger = lambda m : None
+    cache = cache_path(path)
+    key = {"version":CACHE_VERSION, "sha1":content_hash(path)}
+    try:
+        with open("%s.key" % cache, "r") as f:
+            if json.load(f) == key:
+                return DerivedFeatures(numpy.load(cache, mmap_mode="r"))
+    except (IOError, ValueError):
+        pass
+    logger("Calculating the derived feature values of %s...\n" % path)
+    with open(path, "r") as f:
+        table = derive(zoning.ZoningMap(f, streaming = True))
+    try:
+        # write to temporary files first so a concurrent run never maps a partially written cache
+        with open("%s.tmp" % cache, "wb") as f:
+            numpy.save(f, table)
+        with open("%s.key.tmp" % cache, "w") as f:
+            json.dump(key, f)
+        os.rename("%s.tmp" % cache, cache)
+        os.rename("%s.key.tmp" % cache, "%s.key" % cache)
+    except (IOError, OSError):
+        pass
+    return DerivedFeatures(table)
@@ -0,0 +1,92 @@
+import json
+import mmap
+import re
+
+import numpy
+
+# Braces and complete string literals are the only tokens that matter for finding the features of a FeatureCollection.
+# Coordinate arrays, which make up the bulk of a GeoJSON file, contain neither, so the regex skips over them without
+# ever returning to Python.
+_TOKENS = re.compile(br'[{}]|"(?:[^"\\]|\\.)*"')
+_WHITESPACE = b" \t\r\n"
+
+class FeatureStream(object):
+    """Finds the features of a GeoJSON FeatureCollection in a file or buffer without parsing the whole document.
+    Files are memory-mapped, so only the features that are currently being parsed need to be resident."""
+    def __init__(self, source):
+        self._mmap = None
+        if hasattr(source, "fileno"):
+            try:
+                self._mmap = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+                self.data = self._mmap
+            except (ValueError, EnvironmentError):
+                # e.g., empty files, pipes, and sockets cannot be mapped
+                self.data = source.read()
+        elif hasattr(source, "read"):
+            self.data = source.read()
+        else:
+            self.data = source
+        if not isinstance(self.data, (bytes, mmap.mmap)):
+            self.data = self.data.encode("utf-8")
+        self._starts = None
+        self._ends = None
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+    def _is_key(self, end):
+        pos = end
+        while pos < len(self.data) and self.data[pos:pos + 1] in _WHITESPACE:
+            pos += 1
+        return self.data[pos:pos + 1] == b":"
+    def scan(self):
+        """Yields the (start, end) byte offsets of every feature in document order"""
+        depth = 0
+        in_features = False
+        start = None
+        for token in _TOKENS.finditer(self.data):
+            text = token.group()
+            if text == b"{":
+                depth += 1
+                if depth == 2 and in_features:
+                    start = token.start()
+            elif text == b"}":
+                depth -= 1
+                if depth == 1 and start is not None:
+                    yield start, token.end()
+                    start = None
+            elif depth == 1 and self._is_key(token.end()):
+                in_features = text == b'"features"'
+    def _set_index(self, starts, ends):
+        # offsets in files over 4 GB need 64 bits, which array.array does not have on every platform
+        self._starts = numpy.array(starts, dtype = numpy.uint64)
+        self._ends = numpy.array(ends, dtype = numpy.uint64)
+    def build_index(self):
+        if self._starts is None:
+            starts = []
+            ends = []
+            for start, end in self.scan():
+                starts.append(start)
+                ends.append(end)
+            self._set_index(starts, ends)
+    def raw(self, key):
+        self.build_index()
+        return self.data[int(self._starts[key]):int(self._ends[key])]
+    def __len__(self):
+        self.build_index()
+        return len(self._starts)
+    def __getitem__(self, key):
+        return json.loads(self.raw(key))
+    def __iter__(self):
+        if self._starts is not None:
+            for i in range(len(self)):
+                yield self[i]
+        else:
+            # build the index as a side effect of the first full pass
+            starts = []
+            ends = []
+            for start, end in self.scan():
+                starts.append(start)
+                ends.append(end)
+                yield json.loads(self.data[start:end])
+            self._set_index(starts, ends)
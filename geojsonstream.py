@@ -0,0 +1,134 @@
+# Writes GeoJSON one feature at a time, formatting coordinates straight from each geometry's WKB rather than building
+# (and then encoding) nested coordinate tuples with shapely.geometry.mapping.
+#
+# By default the output is byte-for-byte what json.dump writes for the equivalent ZoningFeature.to_geo() dicts. With
+# a precision, coordinates are rounded to that many decimal places. With fast = True, the output has no optional
+# whitespace, and the properties are encoded with ujson when it is installed.
+
+import json
+import struct
+
+import numpy
+from shapely.geometry import mapping
+import shapely.wkb
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+GEOMETRY_TYPES = {1:"Point", 2:"LineString", 3:"Polygon", 4:"MultiPoint", 5:"MultiLineString", 6:"MultiPolygon", 7:"GeometryCollection"}
+
+class _Format(object):
+    def __init__(self, precision, fast):
+        self.precision = precision
+        if fast:
+            self.item_separator, self.key_separator = ",", ":"
+            if ujson is not None:
+                self.dumps = ujson.dumps
+            else:
+                self.dumps = lambda obj : json.dumps(obj, separators = (",", ":"))
+        else:
+            self.item_separator, self.key_separator = ", ", ": "
+            self.dumps = json.dumps
+        self.pair_format = "[%%r%s%%r]" % self.item_separator
+
+class _WKBReader(object):
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+    def header(self):
+        order = "<" if ord(self.data[self.offset:self.offset + 1]) == 1 else ">"
+        geometry_type = struct.unpack_from("%sI" % order, self.data, self.offset + 1)[0]
+        self.offset += 5
+        if geometry_type not in GEOMETRY_TYPES:
+            # e.g., a geometry with Z or M coordinates
+            raise ValueError("Unsupported WKB geometry type %d" % geometry_type)
+        return order, geometry_type
+    def count(self, order):
+        count = struct.unpack_from("%sI" % order, self.data, self.offset)[0]
+        self.offset += 4
+        return count
+    def coordinates(self, order, count):
+        values = numpy.frombuffer(self.data, dtype = "%sf8" % order, count = count * 2, offset = self.offset)
+        self.offset += 16 * count
+        return values.tolist()
+
+def _coordinates_json(values, fmt):
+    if fmt.precision is not None:
+        values = [round(v, fmt.precision) for v in values]
+    return "[%s]" % fmt.item_separator.join([fmt.pair_format % (values[k], values[k + 1]) for k in range(0, len(values), 2)])
+
+def _rings_json(reader, order, fmt):
+    return "[%s]" % fmt.item_separator.join([_coordinates_json(reader.coordinates(order, reader.count(order)), fmt) for r in range(reader.count(order))])
+
+def _read_geometry(reader, fmt):
+    """Reads the next geometry, returning its WKB type and the text of its coordinates (or of a collection's geometries)"""
+    order, geometry_type = reader.header()
+    if geometry_type == 1:
+        coordinates = _coordinates_json(reader.coordinates(order, 1), fmt)[1:-1]
+    elif geometry_type == 2:
+        coordinates = _coordinates_json(reader.coordinates(order, reader.count(order)), fmt)
+    elif geometry_type == 3:
+        coordinates = _rings_json(reader, order, fmt)
+    elif geometry_type == 7:
+        coordinates = "[%s]" % fmt.item_separator.join([_geometry_text(_read_geometry(reader, fmt), fmt) for p in range(reader.count(order))])
+    else:
+        # each part of a multi-geometry has its own WKB header
+        coordinates = "[%s]" % fmt.item_separator.join([_read_geometry(reader, fmt)[1] for p in range(reader.count(order))])
+    return geometry_type, coordinates
+
+def _geometry_text(geometry, fmt):
+    geometry_type, coordinates = geometry
+    member = "geometries" if geometry_type == 7 else "coordinates"
+    # the same order as json.dump writes the members of shapely.geometry.mapping's dicts
+    return '{"type"%s"%s"%s"%s"%s%s}' % (fmt.key_separator, GEOMETRY_TYPES[geometry_type], fmt.item_separator, member, fmt.key_separator, coordinates)
+
+def geometry_json(feature, precision = None, fast = False):
+    """Returns the GeoJSON geometry of a ZoningFeature as text"""
+    fmt = _Format(precision, fast)
+    return _feature_geometry_json(feature, fmt)
+
+def _feature_geometry_json(feature, fmt):
+    try:
+        return _geometry_text(_read_geometry(_WKBReader(feature.wkb()), fmt), fmt)
+    except (ValueError, struct.error):
+        # e.g., an empty point, which has no WKB representation
+        if fmt.precision is not None:
+            raise
+        return fmt.dumps(mapping(feature.geometry))
+
+def _wkb_geometry_json(wkb, fmt):
+    try:
+        return _geometry_text(_read_geometry(_WKBReader(wkb), fmt), fmt)
+    except (ValueError, struct.error):
+        if fmt.precision is not None:
+            raise
+        return fmt.dumps(mapping(shapely.wkb.loads(wkb)))
+
+def _members_json(geo, geometry, fmt):
+    # the members are written in the same order as json.dump would write them
+    return "{%s}" % fmt.item_separator.join(["%s%s%s" % (fmt.dumps(key), fmt.key_separator, geometry if key == "geometry" else fmt.dumps(value)) for key, value in geo.items()])
+
+def _feature_json(feature, fmt):
+    return _members_json(feature.to_geo(include_geometry = False), _feature_geometry_json(feature, fmt), fmt)
+
+def feature_json(feature, precision = None, fast = False):
+    """Returns a ZoningFeature as GeoJSON text"""
+    return _feature_json(feature, _Format(precision, fast))
+
+def wkb_feature_json(properties, wkb, precision = None, fast = False):
+    """Returns GeoJSON text for a feature with the given properties and WKB geometry"""
+    fmt = _Format(precision, fast)
+    # the same members as ZoningFeature.to_geo(), so that they are written in the same order
+    return _members_json({"type":"Feature", "properties":properties, "geometry":None}, _wkb_geometry_json(wkb, fmt), fmt)
+
+def write_feature_collection(features, outstream, precision = None, fast = False):
+    """Writes the features as a GeoJSON feature collection to outstream, one feature at a time"""
+    fmt = _Format(precision, fast)
+    outstream.write('{"type"%s"FeatureCollection"%s"features"%s[' % (fmt.key_separator, fmt.item_separator, fmt.key_separator))
+    for i, feature in enumerate(features):
+        if i > 0:
+            outstream.write(fmt.item_separator)
+        outstream.write(_feature_json(feature, fmt))
+    outstream.write("]}")
@@ -1,31 +1,107 @@
-import bisect
+import checkpoint
+import collections
+import geojsonstream
+import hashlib
 import json
+import metrics
+from metrics import METRICS
+import multiprocessing
+import numpy
+import os
 import progress
+import Queue
+from shapely.geometry import GeometryCollection
+import shapely.prepared
+import spatialindex
+import sys
+import threading
+import time
 import zoning
 
 def calculate_stream_size(stream):
     old_pos = stream.tell()
     stream.seek(0, 2)
-    size = f.tell()
+    size = stream.tell()
     stream.seek(old_pos, 0)
     return size
 
+# pairs are keyed independently of the map sizes, so the keys stay ordered (and correct) as map2 grows; checkpoints store n and i as 32-bit integers
+PAIR_SHIFT = 32
+
+# only one in this many pair classifications is timed, since timing every one would cost about as much as the
+# classification itself; the intersect.classify timer's mean is that of the sample, and its count is the sample size
+CLASSIFY_SAMPLE = 64
+
+def pair_key(n, i):
+    return (n << PAIR_SHIFT) | i
+
 class NullFeatures(object):
+    """The pairs that are known not to intersect, as sorted, non-overlapping runs of inclusive [start, end] pair keys.
+    Regions that overlap or abut are coalesced, so a save state's runs of null pairs collapse into as few regions as possible.
+    The keys need 64 bits, so they are stored in NumPy arrays (array.array has no 64-bit type on every platform), which
+    grow by doubling. Keys are always converted back to Python integers before any arithmetic, since mixing uint64 with
+    Python integers would silently convert them to floats."""
     def __init__(self, map1_len, map2_len):
-        self._mapping = map1_len * map2_len
-        self._max_mapping = self._mapping * map1_len + 1
-        self.regions = []
+        self.starts = numpy.empty(16, dtype = numpy.uint64)
+        self.ends = numpy.empty(16, dtype = numpy.uint64)
+        self._len = 0
+    def __len__(self):
+        return self._len
+    def _set(self, starts, ends):
+        self.starts = numpy.array(starts, dtype = numpy.uint64)
+        self.ends = numpy.array(ends, dtype = numpy.uint64)
+        self._len = len(starts)
+    def _append(self, start, end):
+        if self._len == len(self.starts):
+            self.starts = numpy.concatenate((self.starts, numpy.empty(len(self.starts), dtype = numpy.uint64)))
+            self.ends = numpy.concatenate((self.ends, numpy.empty(len(self.ends), dtype = numpy.uint64)))
+        self.starts[self._len] = start
+        self.ends[self._len] = end
+        self._len += 1
+    def _search(self, key):
+        """Returns the number of regions that start at or before key"""
+        return int(self.starts[:self._len].searchsorted(numpy.uint64(key), side = "right"))
     def add_null_region(self, fromn, fromi, ton, toi):
-        fromid = fromn * self._mapping + fromi
-        toid = ton * self._mapping + toi
-        bisect.insort_right(self.regions, (fromid, toid))
+        start = pair_key(fromn, fromi)
+        end = pair_key(ton, toi)
+        if self._len == 0 or start > int(self.ends[self._len - 1]) + 1:
+            if self._len == 0 or start > int(self.starts[self._len - 1]):
+                # save states record their regions in order, so this is the common case
+                self._append(start, end)
+                return
+        elif start >= int(self.starts[self._len - 1]):
+            self.ends[self._len - 1] = max(int(self.ends[self._len - 1]), end)
+            return
+        starts = self.starts[:self._len].tolist()
+        ends = self.ends[:self._len].tolist()
+        j = self._search(start)
+        if j > 0 and ends[j - 1] + 1 >= start:
+            j -= 1
+            start = starts[j]
+            end = max(end, ends[j])
+        k = j
+        while k < len(starts) and starts[k] <= end + 1:
+            end = max(end, ends[k])
+            k += 1
+        starts[j:k] = [start]
+        ends[j:k] = [end]
+        self._set(starts, ends)
+    def add_null_regions(self, regions):
+        """Adds many (fromn, fromi, ton, toi) regions at once, sorting and coalescing them in a single pass"""
+        keyed = sorted([(pair_key(fromn, fromi), pair_key(ton, toi)) for fromn, fromi, ton, toi in regions] + list(zip(self.starts[:self._len].tolist(), self.ends[:self._len].tolist())))
+        starts = []
+        ends = []
+        for start, end in keyed:
+            if starts and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        self._set(starts, ends)
     def is_null(self, n, i):
-        fid = n * self._mapping + i
-        j = bisect.bisect_right(self.regions, (fid, self._max_mapping))
-        if j == 0:
-            return False
-        else:
-            return self.regions[j - 1][1] >= fid
+        key = pair_key(n, i)
+        j = self._search(key)
+        return j > 0 and int(self.ends[j - 1]) >= key
 
 def load_save_file(stream, logger = None):
     if hasattr(stream, "name"):
@@ -71,6 +147,36 @@ def load_save_file(stream, logger = None):
         save["LAST_INDEX"] = last_index
     return save
 
+class CheckpointState(object):
+    """A save state loaded from a binary checkpoint, with the same interface as the dict returned by load_save_file.
+    The features of each recorded pair are only decoded when that pair is requested."""
+    def __init__(self, reader):
+        self.reader = reader
+        self.pairs = {}
+        self.null_features = NullFeatures(reader.map1_len, reader.map2_len)
+        null_regions = []
+        for kind, n, i, offset in reader.entries:
+            if kind == checkpoint.NULL_REGION_RECORD:
+                null_regions.append(reader.null_region(offset))
+            else:
+                self.pairs[(n, i)] = (kind, offset)
+        self.null_features.add_null_regions(null_regions)
+        self.last_index = reader.last_index()
+    def __contains__(self, key):
+        return key is None or key == "LAST_INDEX" or key in self.pairs
+    def __getitem__(self, key):
+        if key is None:
+            return self.null_features
+        elif key == "LAST_INDEX":
+            return self.last_index
+        kind, offset = self.pairs[key]
+        if kind == checkpoint.EMPTY_PAIR_RECORD:
+            return None
+        return self.reader.features(offset)
+
+def load_checkpoint(path, logger = None):
+    return CheckpointState(checkpoint.CheckpointReader(path, logger = logger))
+
 class StateSaver(object):
     def __init__(self, save_state_to, flush_interval = 50000):
         self.stream = save_state_to
@@ -78,9 +184,25 @@ class StateSaver(object):
         self.current_state_flush = 0
         self.last_state_flush = 0
         self.nulls_start = None
+        # the last pair written, and the last pair written as of the last flush
+        self.last_written = None
+        self.durable_index = None
     def record_map_sizes(self, map1_len, map2_len):
         if self.stream is not None:
-            self.stream.write("%s\n" % json.dumps({"MAP1_LEN" : map1_len, "MAP2_LEN" : map2_len}))
+            self.write_map_sizes(map1_len, map2_len)
+    def write_map_sizes(self, map1_len, map2_len):
+        self.stream.write("%s\n" % json.dumps({"MAP1_LEN" : map1_len, "MAP2_LEN" : map2_len}))
+    def write_null_region(self, fromn, fromi, ton, toi):
+        self.stream.write("[null,[%d,%d],[%d,%d]]\n" % (fromn, fromi, ton, toi))
+    def write_pair(self, n, i, features):
+        # the same text as json.dumps([n, i] + [feature.to_geo() for feature in features])
+        a = ["%d" % n, "%d" % i]
+        for feature in features:
+            if feature is None:
+                a.append("null")
+            else:
+                a.append(geojsonstream.feature_json(feature))
+        self.stream.write("[%s]\n" % ", ".join(a))
     def record(self, n, i, *args):
         if self.stream is None:
             return
@@ -88,33 +210,164 @@ class StateSaver(object):
         flush = (self.current_state_flush - self.last_state_flush) >= self.flush_interval
         if args:
             if self.nulls_start:
-                line = "[null,[%d,%d],[%d,%d]]" % (self.nulls_start[0], self.nulls_start[1], n, i)
-                self.stream.write("%s\n" % line)
+                self.write_null_region(self.nulls_start[0], self.nulls_start[1], n, i)
+                METRICS.count("checkpoint.null_regions")
                 flush = True
                 self.nulls_start = None
-            a = []
-            for arg in args:
-                if arg is None:
-                    a.append(None)
-                else:
-                    a.append(arg.to_geo())
-            line = json.dumps([n, i] + a)
-            self.stream.write("%s\n" % line)
+            self.write_pair(n, i, args)
+            self.last_written = (n, i)
+            METRICS.count("checkpoint.pairs")
         else:
             if self.nulls_start is None:
                 self.nulls_start = [n, i]
             #line = json.dumps([n, i, None])
         if flush:
             self.last_state_flush = self.current_state_flush
-            self.stream.flush()
+            with METRICS.timer("checkpoint.flush"):
+                self.stream.flush()
+            self.durable_index = self.last_written
+
+class CheckpointSaver(StateSaver):
+    """A StateSaver that records to a binary checkpoint file rather than a JSONL stream"""
+    def __init__(self, path, flush_interval = 50000):
+        super(CheckpointSaver, self).__init__(checkpoint.CheckpointWriter(path), flush_interval = flush_interval)
+    def write_map_sizes(self, map1_len, map2_len):
+        if not self.stream.has_header:
+            self.stream.write_header(map1_len, map2_len)
+    def write_null_region(self, fromn, fromi, ton, toi):
+        self.stream.write_null_region(fromn, fromi, ton, toi)
+    def write_pair(self, n, i, features):
+        self.stream.write_pair(n, i, features)
+    def close(self):
+        self.stream.close()
+        self.durable_index = self.last_written
+
+class BackgroundSaver(object):
+    """Wraps a StateSaver so that records are encoded and written (and incremental saves are written) by a background
+    thread, in order. record() only blocks when max_pending records are already waiting to be written.
+    An error in the background thread is raised by the next call from the intersection."""
+    def __init__(self, saver, max_pending = 10000, logger = None):
+        if logger is None:
+            logger = lambda m : None
+        self.saver = saver
+        self.logger = logger
+        self.queue = Queue.Queue(max_pending)
+        self.recorded = None
+        self.error = None
+        self.thread = threading.Thread(target = self._run, name = "BackgroundSaver")
+        self.thread.daemon = True
+        self.thread.start()
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            elif self.error is not None:
+                # keep draining the queue so the intersection never blocks on it
+                continue
+            method, args = item
+            try:
+                method(*args)
+            except Exception:
+                self.error = sys.exc_info()
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+    def _put(self, method, *args):
+        self._check_error()
+        self.queue.put((method, args))
+    def record_map_sizes(self, map1_len, map2_len):
+        self._put(self.saver.record_map_sizes, map1_len, map2_len)
+    def record(self, n, i, *args):
+        self.recorded = (n, i)
+        self._put(self.saver.record, n, i, *args)
+    def lag(self):
+        """Returns a description of how far the durable save state is behind the pairs that have been processed"""
+        return "the save state is durable through pair %s; the last pair processed is %s, and %d records are waiting to be written" % (self.saver.durable_index, self.recorded, self.queue.qsize())
+    def save_snapshot(self, snapshot, path):
+        """Writes the snapshot of a map (see ModifiableMap.snapshot) to path once every record before it is written"""
+        self._put(_save_atomically, snapshot, path)
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if hasattr(self.saver, "close"):
+            self.saver.close()
+        self._check_error()
+
+def _save_atomically(zoning_map, path):
+    with METRICS.timer("intersect.incremental_save"):
+        # write to a temporary file first so an interrupted save never replaces the previous one
+        with open("%s.tmp" % path, 'w') as f:
+            zoning_map.save(f)
+        os.rename("%s.tmp" % path, path)
 
-def intersect(map1, map2, logger = None, previous_save = None, save_state_to = None, incremental_save_path = None, incremental_save_time = 600):
+def convert_save_file(from_path, to_path):
+    """Converts a JSONL save state to a binary checkpoint, or a binary checkpoint to a JSONL save state"""
+    if checkpoint.is_checkpoint(from_path):
+        reader = checkpoint.CheckpointReader(from_path)
+        with open(to_path, 'w') as stream:
+            saver = StateSaver(stream)
+            saver.write_map_sizes(reader.map1_len, reader.map2_len)
+            for kind, n, i, offset in reader.entries:
+                if kind == checkpoint.NULL_REGION_RECORD:
+                    saver.write_null_region(*reader.null_region(offset))
+                elif kind == checkpoint.EMPTY_PAIR_RECORD:
+                    stream.write("%s\n" % json.dumps([n, i, None]))
+                else:
+                    saver.write_pair(n, i, reader.features(offset))
+        reader.close()
+    else:
+        writer = checkpoint.CheckpointWriter(to_path)
+        with open(from_path, 'r') as stream:
+            for line in stream:
+                data = json.loads(line)
+                if not writer.has_header:
+                    writer.write_header(data["MAP1_LEN"], data["MAP2_LEN"])
+                elif data[0] is None:
+                    writer.write_null_region(data[1][0], data[1][1], data[2][0], data[2][1])
+                elif data[2] is None:
+                    writer.write_pair(data[0], data[1], None)
+                else:
+                    writer.write_pair(data[0], data[1], [None if f is None else zoning.feature_from_geo(f) for f in data[2:]])
+        writer.close()
+
+DISJOINT, CONTAINS, CONTAINED, OVERLAPS = range(4)
+
+def classify_pair(prepared1, geometry1, geometry2):
+    """Returns DISJOINT, CONTAINS (geometry1 covers geometry2), CONTAINED (geometry2 covers geometry1), or OVERLAPS
+    (any other intersection), using only predicates on the prepared geometry1, so that the first three cases never
+    have to construct an intersection.
+    Using the covered geometry in place of the intersection is exact geometrically, but it is not what GEOS would
+    have returned byte for byte: an intersection's rings can start at a different vertex, run in a different order,
+    or be noded differently. So the geometries written for CONTAINS and CONTAINED pairs, and the remainders (and
+    later intersections) computed from them, can have different coordinates than if every pair were intersected,
+    although they cover the same areas."""
+    try:
+        if prepared1.disjoint(geometry2):
+            return DISJOINT
+        bounds1 = geometry1.bounds
+        bounds2 = geometry2.bounds
+        if spatialindex.bounds_intersect(bounds1, bounds2):
+            if bounds1[0] <= bounds2[0] and bounds1[1] <= bounds2[1] and bounds1[2] >= bounds2[2] and bounds1[3] >= bounds2[3] and prepared1.covers(geometry2):
+                return CONTAINS
+            elif bounds2[0] <= bounds1[0] and bounds2[1] <= bounds1[1] and bounds2[2] >= bounds1[2] and bounds2[3] >= bounds1[3] and prepared1.within(geometry2):
+                return CONTAINED
+    except Exception:
+        # e.g., an invalid geometry; the exact path reports any error
+        pass
+    return OVERLAPS
+
+def intersect(map1, map2, logger = None, previous_save = None, save_state_to = None, incremental_save_path = None, incremental_save_time = 600, spatial_index = True, saver = None, compact = True, shared_progress = None, shared_weight = 1.0):
+    """If shared_progress is a progress.SharedCounter, the fraction of the pairs that have been processed (times
+    shared_weight) is added to it as the intersection progresses"""
     if logger is None:
         logger = lambda m : None
-    map1 = zoning.ModifiableMap(map1)
-    map2 = zoning.ModifiableMap(map2)
-    estimator = progress.TimeEstimator(logger, 0, len(map1) * len(map2), precision = 2, interval = 3.0)
-    saver = StateSaver(save_state_to)
+    map1 = zoning.ModifiableMap(map1, compact = compact)
+    map2 = zoning.ModifiableMap(map2, spatial_index = spatial_index, compact = compact)
+    estimator = progress.TimeEstimator(logger, 0, len(map1) * len(map2), precision = 2, interval = 3.0, shared = shared_progress, shared_weight = shared_weight)
+    if saver is None:
+        saver = StateSaver(save_state_to)
     last_incremental_save = 0
     if previous_save is not None:
         logger("\r%s\rFast-forwarding using saved state...\n" % (' ' * 40))
@@ -122,10 +375,23 @@ def intersect(map1, map2, logger = None, previous_save = None, save_state_to = N
         estimator.end_value = (last_n - 1) * len(map2) + last_i
     else:
         saver.record_map_sizes(len(map1), len(map2))
+    classified = 0
     for n, f1 in enumerate(map1):
         if f1.geometry.is_empty:
             continue
-        for i, f2 in enumerate(map2):
+        if spatial_index:
+            # only features whose bounding boxes overlap f1 can possibly intersect it;
+            # every other pair would be recorded as empty anyway
+            candidates = map2.intersecting(f1.geometry.bounds)
+        else:
+            candidates = range(len(map2))
+        # f1 itself is never modified while its candidates are processed, so it only has to be prepared once
+        prepared = None
+        METRICS.maybe_export()
+        # the counters of the cheap, per-pair outcomes are added to METRICS once per row
+        counts = collections.defaultdict(int)
+        for i in candidates:
+            f2 = map2[i]
             if previous_save is not None and n <= last_n:
                 if (n, i) in previous_save:
                     state = previous_save[(n,i)]
@@ -135,12 +401,14 @@ def intersect(map1, map2, logger = None, previous_save = None, save_state_to = N
                     if state[1] is not None:
                         map2.append(state[1])
                     map1[n] = state[2]
+                    counts["intersect.resumed_pairs"] += 1
                     estimator.increment()
                     if map1[n].geometry.is_empty:
                         estimator.increment(len(map2) - i)
                         break
                     continue
                 elif previous_save[None].is_null(n, i):
+                    counts["intersect.resumed_pairs"] += 1
                     estimator.increment()
                     continue
                 elif n < last_n or (n == last_n and i <= last_i):
@@ -150,24 +418,58 @@ def intersect(map1, map2, logger = None, previous_save = None, save_state_to = N
                     estimator.end_value = len(map1) * len(map2)
                     logger("\r%s\rDone.\n" % (' ' * 40))
             estimator.update(n * len(map2) + i)
+            counts["intersect.pairs"] += 1
             if f2.geometry.is_empty:
+                counts["intersect.empty_pairs"] += 1
                 saver.record(n, i)
                 continue
-            try:
-                isect = f1.geometry.intersection(f2.geometry)
-            except Exception as e:
-                logger("\r%s\rError: %s\n" % (' ' * 40, e))
-                estimator.force_next_refresh()
-                continue
-            if isect.is_empty:
+            if prepared is None:
+                prepared = shapely.prepared.prep(f1.geometry)
+            classified += 1
+            if classified % CLASSIFY_SAMPLE == 0:
+                start = time.time()
+                relation = classify_pair(prepared, f1.geometry, f2.geometry)
+                METRICS.add_time("intersect.classify", time.time() - start)
+            else:
+                relation = classify_pair(prepared, f1.geometry, f2.geometry)
+            if relation == DISJOINT:
+                counts["intersect.empty_pairs"] += 1
                 saver.record(n, i)
                 continue
+            elif relation == CONTAINS:
+                # f2 lies entirely within f1, so their intersection is f2 itself (and f1's remainder is computed from
+                # f2's own geometry rather than from an intersection, so its coordinates can differ; see classify_pair)
+                counts["intersect.contained_pairs"] += 1
+                isect = f2.geometry
+            elif relation == CONTAINED:
+                # f1 lies entirely within f2, so the intersected feature takes f1's own geometry, and nothing of f1 is
+                # left over
+                counts["intersect.contained_pairs"] += 1
+                isect = f1.geometry
+            else:
+                try:
+                    with METRICS.timer("intersect.intersection"):
+                        isect = f1.geometry.intersection(f2.geometry)
+                except Exception as e:
+                    METRICS.count("intersect.errors")
+                    logger("\r%s\rError: %s\n" % (' ' * 40, e))
+                    estimator.force_next_refresh()
+                    continue
+                if isect.is_empty:
+                    counts["intersect.empty_pairs"] += 1
+                    saver.record(n, i)
+                    continue
             area_delta = 10.0 # square meters
             new_feature = zoning.ZoningFeature("%s->%s" % (f1.objectid, f2.objectid), f2.zoning, isect, f2.old_zoning + f1.zoning)
+            if relation == CONTAINS:
+                new_feature._area = f2.area()
+            elif relation == CONTAINED:
+                new_feature._area = f1.area()
             new_state = [None, None, None]
             if new_feature.area() < area_delta:
                 # The intersection is less than area_delta square meters, so it's probably just floating point error.
                 # Skip it!
+                METRICS.count("intersect.skipped_pairs")
                 saver.record(n, i)
                 continue
             elif f2.area() - area_delta < new_feature.area():
@@ -175,56 +477,428 @@ def intersect(map1, map2, logger = None, previous_save = None, save_state_to = N
                 new_feature = zoning.ZoningFeature("%s->%s" % (f1.objectid, f2.objectid), f2.zoning, f2.geometry, f2.old_zoning + f1.zoning)
             else:
                 # add a new feature containing the portion of f2 that does not intersect with f1
-                new_geom = f2.geometry.difference(new_feature.geometry)
+                with METRICS.timer("intersect.difference"):
+                    new_geom = f2.geometry.difference(new_feature.geometry)
                 if not new_geom.is_empty:
+                    METRICS.count("intersect.split_features")
                     map2.append(zoning.ZoningFeature("%s.2" % f2.objectid, f2.zoning, new_geom, f2.old_zoning))
                     estimator.end_value = len(map1) * len(map2)
-                    new_state[1] = map2[-1]
+                    new_state[1] = map2[len(map2) - 1]
             map2[i] = new_feature
             new_state[0] = map2[i]
+            METRICS.count("intersect.changed_pairs")
             logger("\r%s\rPlot %s (%.02f acres) -> %s (%.02f acres) went from %s to %s\n" % (' ' * 40, f1.objectid, zoning.square_meters_to_acres(f1.area()), f2.objectid, zoning.square_meters_to_acres(new_feature.area()), f1.zoning, f2.zoning))
             estimator.force_next_refresh()
             # Delete the portion of overlap in f1 to hopefully speed up further comparisons:
             # (This is making the assumption that the zoning regions in map2 are non-overlapping)
-            map1[n] = zoning.ZoningFeature(f1.objectid, f1.zoning, f1.geometry.difference(isect))
+            if relation == CONTAINED:
+                # nothing is left of f1
+                map1[n] = zoning.ZoningFeature(f1.objectid, f1.zoning, GeometryCollection())
+            else:
+                with METRICS.timer("intersect.difference"):
+                    remainder = f1.geometry.difference(isect)
+                map1[n] = zoning.ZoningFeature(f1.objectid, f1.zoning, remainder)
             new_state[2] = map1[n]
             saver.record(n, i, *new_state)
             if incremental_save_path and estimator.get_time() - last_incremental_save >= incremental_save_time:
                 # do an incremental save once every incremental_save_time seconds
-                logger("\r%s\rDoing an incremental save to %s..." % (' ' * 40, incremental_save_path))
                 last_incremental_save = estimator.get_time()
-                with open(incremental_save_path, 'w') as f:
-                    map2.save(f)
+                if hasattr(saver, "save_snapshot"):
+                    # the map is written in the background, from a copy that is unaffected by the intersection
+                    logger("\r%s\rQueued an incremental save to %s (%s)\n" % (' ' * 40, incremental_save_path, saver.lag()))
+                    saver.save_snapshot(map2.snapshot(), incremental_save_path)
+                else:
+                    logger("\r%s\rDoing an incremental save to %s..." % (' ' * 40, incremental_save_path))
+                    _save_atomically(map2, incremental_save_path)
             if map1[n].geometry.is_empty:
                 break
+        for name, value in counts.items():
+            METRICS.count(name, value)
+    estimator.finish()
     logger('\n')
     return map2
 
+class ShardRecorder(object):
+    """A StateSaver stand-in that remembers which pair produced each appended feature"""
+    def __init__(self):
+        self.appended_by = []
+    def record_map_sizes(self, map1_len, map2_len):
+        pass
+    def record(self, n, i, *args):
+        if args and args[1] is not None:
+            self.appended_by.append((n, i))
+
+_shard_progress = None
+
+def _init_shard_worker(shared_progress):
+    global _shard_progress
+    _shard_progress = shared_progress
+
+def _intersect_shard(args):
+    shard_id, (map1_indexes, map1_features, map2_indexes, map2_features) = args
+    recorder = ShardRecorder()
+    # each shard contributes its number of map2 features to the total progress
+    result = intersect(map1_features, map2_features, saver = recorder, shared_progress = _shard_progress, shared_weight = len(map2_indexes))
+    appended = []
+    for (n, i), feature in zip(recorder.appended_by, [result[i] for i in range(len(map2_indexes), len(result))]):
+        if i < len(map2_indexes):
+            source = (0, map2_indexes[i])
+        else:
+            # the split feature was itself appended earlier in this shard
+            source = (1, i - len(map2_indexes))
+        appended.append((map1_indexes[n], source, feature))
+    return shard_id, (map2_indexes, [result[i] for i in range(len(map2_indexes))], appended)
+
+def make_shards(map1, map2, num_tiles):
+    """Partitions map2 into spatial tiles (by bounding box center) and pairs each tile with the map1 features that overlap it"""
+    map1 = zoning.ModifiableMap(map1, spatial_index = True)
+    map2 = list(map2)
+    centers = []
+    for i, feature in enumerate(map2):
+        bounds = feature.geometry.bounds
+        if not spatialindex.is_empty_bounds(bounds):
+            centers.append(((bounds[0] + bounds[2]) / 2.0, (bounds[1] + bounds[3]) / 2.0, i))
+    if not centers:
+        return []
+    # cut the map into vertical strips and then each strip into tiles, each with roughly the same number of features
+    strips = max(int(num_tiles ** 0.5 + 0.5), 1)
+    tiles_per_strip = max(int(float(num_tiles) / strips + 0.5), 1)
+    centers.sort()
+    strip_size = (len(centers) + strips - 1) // strips
+    shards = []
+    for s in range(0, len(centers), strip_size):
+        strip = sorted(centers[s:s + strip_size], key = lambda c : (c[1], c[0], c[2]))
+        tile_size = (len(strip) + tiles_per_strip - 1) // tiles_per_strip
+        for t in range(0, len(strip), tile_size):
+            map2_indexes = sorted(c[2] for c in strip[t:t + tile_size])
+            map1_indexes = set()
+            for i in map2_indexes:
+                map1_indexes.update(map1.intersecting(map2[i].geometry.bounds))
+            map1_indexes = sorted(map1_indexes)
+            shards.append((map1_indexes, [map1[n] for n in map1_indexes], map2_indexes, [map2[i] for i in map2_indexes]))
+    return shards
+
+def merge_shards(map2, results, appended_by = None):
+    """Reassembles per-shard results into the map that the serial intersect() would have produced.
+    If appended_by is a list, the (n, i) pair that split off each appended feature is added to it, in order."""
+    merged = list(map2)
+    events = []
+    for shard_id, (map2_indexes, features, appended) in enumerate(results):
+        for i, feature in zip(map2_indexes, features):
+            merged[i] = feature
+        for local_index, (n, source, feature) in enumerate(appended):
+            events.append((n, shard_id, local_index, source, feature))
+    # The serial algorithm appends features in order of n, and for a given n in the order that the split features
+    # appear in map2: original features by index, followed by appended features by the order in which they were appended.
+    global_index = {}
+    def order(event):
+        n, shard_id, local_index, source, feature = event
+        if source[0] == 0:
+            return (n, 0, source[1])
+        else:
+            return (n, 1, global_index[(shard_id, source[1])])
+    events.sort(key = lambda e : e[0])
+    start = 0
+    while start < len(events):
+        end = start
+        while end < len(events) and events[end][0] == events[start][0]:
+            end += 1
+        # features appended while processing n can only have been split by a later n, so their order is already known:
+        for event in sorted(events[start:end], key = order):
+            n, shard_id, local_index, source, feature = event
+            if appended_by is not None:
+                if source[0] == 0:
+                    appended_by.append((n, source[1]))
+                else:
+                    appended_by.append((n, global_index[(shard_id, source[1])]))
+            global_index[(shard_id, local_index)] = len(merged)
+            merged.append(feature)
+        start = end
+    return merged
+
+def parallel_intersect(map1, map2, workers = None, logger = None, tiles_per_worker = 4, appended_by = None):
+    """Splits map2 into spatial tiles and intersects each tile with the overlapping portion of map1 in a process pool.
+    The output is identical to that of intersect(), under the same assumption that the zoning regions in map2 do not overlap.
+    Save states and incremental saves are not supported, but if appended_by is a list, the provenance of the result
+    (see merge_shards) is added to it."""
+    if logger is None:
+        logger = lambda m : None
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    map2 = list(map2)
+    shards = make_shards(map1, map2, workers * tiles_per_worker)
+    estimator = progress.TimeEstimator(logger, 0, sum(len(shard[2]) for shard in shards), precision = 1)
+    shared_progress = progress.SharedCounter()
+    pool = multiprocessing.Pool(workers, _init_shard_worker, (shared_progress,))
+    try:
+        results = [None] * len(shards)
+        shard_results = pool.imap_unordered(metrics.Collected(_intersect_shard), enumerate(shards))
+        for _ in range(len(shards)):
+            while True:
+                # the workers report their progress through shared memory while their shards are still running
+                try:
+                    (shard_id, result), snapshot = shard_results.next(timeout = estimator.interval)
+                    break
+                except multiprocessing.TimeoutError:
+                    estimator.update(min(shared_progress.value, estimator.end_value))
+            METRICS.merge(snapshot)
+            results[shard_id] = result
+            estimator.update(min(shared_progress.value, estimator.end_value))
+        # the shared total can be off from the end by a rounding error
+        estimator.update(estimator.end_value)
+    finally:
+        pool.terminate()
+    logger('\n')
+    intersected = zoning.ModifiableMap([])
+    for feature in merge_shards(map2, results, appended_by = appended_by):
+        intersected.append(feature)
+    return intersected
+
+def appended_by_from_save(save, map2 = None):
+    """Returns the (n, i) pair that split off each appended feature, in the order that they were appended,
+    from a complete save state (as returned by load_save_file or load_checkpoint).
+    Save states written by older versions recorded null instead of the feature that was split off. If map2 (the map2
+    of the run that wrote the save state) is given, the pairs are replayed against it, and a ValueError is raised if
+    any pair split its feature without recording the split-off feature."""
+    if isinstance(save, CheckpointState):
+        pairs = [key for key, (kind, offset) in save.pairs.items() if kind == checkpoint.CHANGED_PAIR_RECORD]
+    else:
+        pairs = [key for key in save if isinstance(key, tuple) and save[key] is not None]
+    # pairs are processed (and therefore append their features) in order of n and then i
+    pairs = sorted(pairs)
+    if map2 is None:
+        return [pair for pair in pairs if save[pair][1] is not None]
+    appended_by = []
+    # the geometry of every map2 feature that a pair has changed, by index
+    geometries = {}
+    for n, i in pairs:
+        features = save[(n, i)]
+        if features[1] is None:
+            if i in geometries:
+                previous = geometries[i]
+            elif i < len(map2):
+                previous = map2[i].geometry
+            else:
+                previous = None
+            # a pair that did not split its feature replaces it with a feature that has the very same geometry
+            if previous is None or not features[0].geometry.equals_exact(previous, 0.0):
+                raise ValueError("Pair (%d, %d) of the save state split its feature without recording the split-off feature (the save state was probably written by an older version); re-run the intersection in full" % (n, i))
+        else:
+            appended_by.append((n, i))
+            geometries[len(map2) + len(appended_by) - 1] = features[1].geometry
+        geometries[i] = features[0].geometry
+    return appended_by
+
+def provenance_path(save_state_path):
+    return "%s.provenance" % save_state_path
+
+def save_provenance(path, map2_len, appended_by):
+    with open(path, 'w') as f:
+        json.dump({"MAP2_LEN" : map2_len, "APPENDED_BY" : [list(pair) for pair in appended_by]}, f)
+
+def load_provenance(path, map2 = None, logger = None):
+    """Loads the appended_by list of an intersected map from a provenance file written by save_provenance,
+    or from the save state (JSONL or binary checkpoint) of the run that produced it (see appended_by_from_save for
+    map2)"""
+    if checkpoint.is_checkpoint(path):
+        return appended_by_from_save(load_checkpoint(path, logger = logger), map2 = map2)
+    with open(path, 'r') as f:
+        first_line = f.readline()
+        data = json.loads(first_line)
+        if "APPENDED_BY" in data:
+            return [tuple(pair) for pair in data["APPENDED_BY"]]
+        f.seek(0)
+        return appended_by_from_save(load_save_file(f), map2 = map2)
+
+def feature_digest(geojson):
+    return hashlib.sha1(json.dumps([geojson["properties"], geojson["geometry"]], sort_keys = True)).hexdigest()
+
+def _map_digests(zoning_map):
+    digests = {}
+    for i in range(len(zoning_map)):
+        geojson = json.loads(zoning_map.raw(i))
+        objectid = geojson["properties"]["OBJECTID"]
+        if objectid in digests:
+            # OBJECTIDs that are not unique cannot be matched between maps
+            digests[objectid] = (None, None)
+        else:
+            digests[objectid] = (i, feature_digest(geojson))
+    return digests
+
+def _load_output(intersected, i):
+    # intersected maps are written with to_geo(), so read them back with its exact inverse
+    return zoning.feature_from_geo(json.loads(intersected.raw(i)))
+
+def incremental_intersect(map1, old_map2, new_map2, old_intersected, appended_by, logger = None):
+    """Updates old_intersected, the result of intersecting map1 with old_map2, to the result of intersecting map1 with new_map2.
+    appended_by is the provenance of old_intersected's appended features (see load_provenance).
+    Only the features of new_map2 that were added or changed (by OBJECTID and a hash of their properties and geometry),
+    together with their neighbors that overlap the same map1 features, are re-intersected; the results for every other
+    feature are taken from old_intersected. Returns the new intersected map and its appended_by list.
+    Like parallel_intersect, this assumes that the zoning regions in map2 do not overlap."""
+    if logger is None:
+        logger = lambda m : None
+    if len(old_intersected) != len(old_map2) + len(appended_by):
+        raise ValueError("The old intersected map has %d features, but its provenance accounts for %d (%d from the old map2 and %d appended); re-run the intersection in full, or regenerate the provenance from the save state of the run that produced the old intersected map" % (len(old_intersected), len(old_map2) + len(appended_by), len(old_map2), len(appended_by)))
+    old_digests = _map_digests(old_map2)
+    new_digests = _map_digests(new_map2)
+    old_to_new = {}
+    for objectid, (j, digest) in new_digests.items():
+        if objectid in old_digests and digest is not None and old_digests[objectid][1] == digest:
+            old_to_new[old_digests[objectid][0]] = j
+    map1 = zoning.ModifiableMap(map1, spatial_index = True)
+    old_map2 = list(old_map2)
+    new_map2 = zoning.ModifiableMap(new_map2, spatial_index = True)
+    unchanged_new = set(old_to_new.values())
+    changed = [j for j in range(len(new_map2)) if j not in unchanged_new]
+    # the map1 features that overlap any added, changed, or removed feature
+    affected = set()
+    for j in changed:
+        affected.update(map1.intersecting(new_map2[j].geometry.bounds))
+    for i, feature in enumerate(old_map2):
+        if i not in old_to_new:
+            affected.update(map1.intersecting(feature.geometry.bounds))
+    recompute = set(changed)
+    for n in affected:
+        recompute.update(new_map2.intersecting(map1[n].geometry.bounds))
+    recompute = sorted(recompute)
+    logger("%d of %d features changed; re-intersecting %d features\n" % (len(changed), len(new_map2), len(recompute)))
+    # the unchanged results, as if they were the output of a shard
+    kept = sorted(i for i in old_to_new if old_to_new[i] not in recompute)
+    kept_set = set(kept)
+    old_map2_len = len(old_map2)
+    root = []
+    local = {}
+    appended = []
+    for k, (n, i) in enumerate(appended_by):
+        if i < old_map2_len:
+            root.append(i)
+            source = (0, old_to_new.get(i))
+        else:
+            root.append(root[i - old_map2_len])
+            source = (1, local.get(i - old_map2_len))
+        if root[k] in kept_set:
+            local[k] = len(appended)
+            appended.append((n, source, _load_output(old_intersected, old_map2_len + k)))
+    results = [([old_to_new[i] for i in kept], [_load_output(old_intersected, i) for i in kept], appended)]
+    if recompute:
+        map1_indexes = set()
+        for j in recompute:
+            map1_indexes.update(map1.intersecting(new_map2[j].geometry.bounds))
+        map1_indexes = sorted(map1_indexes)
+        shard = (map1_indexes, [map1[n] for n in map1_indexes], recompute, [new_map2[j] for j in recompute])
+        results.append(_intersect_shard((1, shard))[1])
+    new_appended_by = []
+    intersected = zoning.ModifiableMap([])
+    for feature in merge_shards(list(new_map2), results, appended_by = new_appended_by):
+        intersected.append(feature)
+    return intersected, new_appended_by
+
 if __name__ == "__main__":
     import os
     import sys
 
-    with open(sys.argv[1], 'r') as f1:
-        with open(sys.argv[2], 'r') as f2:
+    args = metrics.configure(sys.argv[1:])
+    # options for writing the intersected map: --precision DIGITS rounds its coordinates, and --fast-json writes it
+    # without optional whitespace (using ujson for the properties, if it is installed)
+    save_options = {}
+    if "--precision" in args:
+        i = args.index("--precision")
+        save_options["precision"] = int(args[i + 1])
+        del args[i:i + 2]
+    if "--fast-json" in args:
+        args.remove("--fast-json")
+        save_options["fast"] = True
+    # --columnar writes the intersected map in the columnar format (see columnar) rather than as GeoJSON
+    columnar_output = "--columnar" in args
+    if columnar_output:
+        args.remove("--columnar")
+    def save(zoning_map):
+        if columnar_output:
+            zoning_map.save_columnar(sys.stdout)
+        else:
+            zoning_map.save(sys.stdout, **save_options)
+    if args and args[0] == "--convert-save-state":
+        convert_save_file(args[1], args[2])
+        sys.exit(0)
+    elif args and args[0] == "--incremental":
+        # --incremental MAP1 OLD_MAP2 NEW_MAP2 OLD_INTERSECTED OLD_SAVE_STATE_OR_PROVENANCE [NEW_PROVENANCE]
+        def logger(msg):
+            sys.stderr.write(msg)
+            sys.stderr.flush()
+        maps = [open(path, 'r') for path in args[1:5]]
+        try:
+            zoning_maps = [zoning.ZoningMap(f, streaming = True) for f in maps]
+            try:
+                appended_by = load_provenance(args[5], map2 = zoning_maps[1], logger = logger)
+                intersected, appended_by = incremental_intersect(*zoning_maps, appended_by = appended_by, logger = logger)
+            except ValueError as e:
+                logger("\r%s\rError: %s\n" % (' ' * 40, e))
+                sys.exit(1)
+        finally:
+            for f in maps:
+                f.close()
+        save(intersected)
+        if len(args) >= 7:
+            save_provenance(args[6], len(intersected) - len(appended_by), appended_by)
+        sys.exit(0)
+    workers = 1
+    if "--workers" in args:
+        i = args.index("--workers")
+        workers = int(args[i + 1])
+        del args[i:i + 2]
+
+    with open(args[0], 'r') as f1:
+        with open(args[1], 'r') as f2:
             def logger(msg):
                 sys.stderr.write(msg)
                 sys.stderr.flush()
             previous_save = None
             save_state_to = None
-            if len(sys.argv) >= 4:
-                if os.path.exists(sys.argv[3]):
-                    logger('Loading save state...\n')
-                    with open(sys.argv[3], 'r') as f:
-                        previous_save = load_save_file(f)
-                    logger("\r%s\rLoaded.\n" % (' ' * 40))
-                save_state_to = open(sys.argv[3], 'a')
-            try:
-                intersected = intersect(zoning.ZoningMap(f1), zoning.ZoningMap(f2), logger = logger, previous_save = previous_save, save_state_to = save_state_to, incremental_save_path = "%s.incremental" % sys.argv[3])
-            finally:
-                if save_state_to is not None:
-                    save_state_to.close()
-            intersected.save(sys.stdout)
-            os.unlink("%s.incremental" % sys.argv[3])
+            saver = None
+            incremental_save_path = None
+            if workers > 1:
+                appended_by = None
+                if len(args) >= 3:
+                    # there is nothing to resume, but the provenance is still recorded for later --incremental runs
+                    logger("Save states are not supported with more than one worker; writing only the provenance of the result to %s\n" % provenance_path(args[2]))
+                    appended_by = []
+                intersected = parallel_intersect(zoning.ZoningMap(f1, streaming = True), zoning.ZoningMap(f2, streaming = True), workers = workers, logger = logger, appended_by = appended_by)
+                if appended_by is not None:
+                    save_provenance(provenance_path(args[2]), len(intersected) - len(appended_by), appended_by)
+            else:
+                if len(args) >= 3:
+                    # new save states are binary checkpoints, but existing JSONL save states can still be resumed
+                    exists = os.path.exists(args[2]) and os.path.getsize(args[2]) > 0
+                    is_checkpoint = not exists or checkpoint.is_checkpoint(args[2])
+                    if exists:
+                        logger('Loading save state...\n')
+                        if is_checkpoint:
+                            previous_save = load_checkpoint(args[2], logger = logger)
+                        else:
+                            with open(args[2], 'r') as f:
+                                previous_save = load_save_file(f)
+                        if previous_save["LAST_INDEX"] is None:
+                            previous_save = None
+                        logger("\r%s\rLoaded.\n" % (' ' * 40))
+                    if is_checkpoint:
+                        saver = CheckpointSaver(args[2])
+                    else:
+                        save_state_to = open(args[2], 'a')
+                        saver = StateSaver(save_state_to)
+                    saver = BackgroundSaver(saver, logger = logger)
+                    incremental_save_path = "%s.incremental" % args[2]
+                try:
+                    intersected = intersect(zoning.ZoningMap(f1, streaming = True), zoning.ZoningMap(f2, streaming = True), logger = logger, previous_save = previous_save, incremental_save_path = incremental_save_path, saver = saver)
+                finally:
+                    # every pending record is written before the save state is closed
+                    if saver is not None:
+                        saver.close()
+                    if save_state_to is not None:
+                        save_state_to.close()
+            save(intersected)
+            if incremental_save_path is not None and os.path.exists(incremental_save_path):
+                os.unlink(incremental_save_path)
             ## Sanity check:
             #import StringIO
             #output = StringIO.StringIO()
@@ -0,0 +1,83 @@
+from xml.sax.saxutils import escape, quoteattr
+
+from shapely.geometry import GeometryCollection, LinearRing, LineString, MultiLineString, MultiPoint, MultiPolygon, Point, Polygon
+
+KML_NAMESPACE = "http://www.opengis.net/kml/2.2"
+
+def _coordinates(coords):
+    # same formatting as fastkml
+    return "<coordinates>%s</coordinates>" % ' '.join(','.join('%f' % v for v in c) for c in coords)
+
+def geometry_to_kml(geometry):
+    if isinstance(geometry, Point):
+        return "<Point>%s</Point>" % _coordinates(geometry.coords)
+    elif isinstance(geometry, LinearRing):
+        return "<LinearRing>%s</LinearRing>" % _coordinates(geometry.coords)
+    elif isinstance(geometry, LineString):
+        return "<LineString>%s</LineString>" % _coordinates(geometry.coords)
+    elif isinstance(geometry, Polygon):
+        kml = ["<Polygon><outerBoundaryIs>%s</outerBoundaryIs>" % geometry_to_kml(geometry.exterior)]
+        for interior in geometry.interiors:
+            kml.append("<innerBoundaryIs>%s</innerBoundaryIs>" % geometry_to_kml(interior))
+        kml.append("</Polygon>")
+        return ''.join(kml)
+    elif isinstance(geometry, (MultiPoint, MultiLineString, MultiPolygon, GeometryCollection)):
+        return "<MultiGeometry>%s</MultiGeometry>" % ''.join(geometry_to_kml(part) for part in geometry.geoms)
+    raise ValueError("Illegal geometry type.")
+
+def region_to_kml(west, south, east, north, min_lod_pixels = 0, max_lod_pixels = -1):
+    """Returns a KML Region, which is only active while its box is between min_lod_pixels and max_lod_pixels (-1 for
+    no limit) across on screen"""
+    return "<Region><LatLonAltBox><north>%f</north><south>%f</south><east>%f</east><west>%f</west></LatLonAltBox><Lod><minLodPixels>%d</minLodPixels><maxLodPixels>%d</maxLodPixels></Lod></Region>" % (north, south, east, west, min_lod_pixels, max_lod_pixels)
+
+def _style(color, fill, outline):
+    return "<PolyStyle><color>%s</color><fill>%d</fill><outline>%d</outline></PolyStyle>" % (escape(color), fill, outline)
+
+class KMLWriter(object):
+    """Writes a KML document to a stream one placemark at a time, so the document never has to be held in memory.
+    Polygon styles that are declared up front (before the first folder) are shared by id; any other style is
+    written inline in the placemark that uses it. region is the optional KML Region (see region_to_kml) of the
+    whole document."""
+    def __init__(self, stream, document_id, name, description, region = None):
+        self.stream = stream
+        self.styles = {}
+        self._in_folder = False
+        if region is None:
+            region = ""
+        self._write('<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="%s"><Document id=%s><name>%s</name><visibility>1</visibility><description>%s</description>%s\n' % (KML_NAMESPACE, quoteattr(document_id), escape(name), escape(description), region))
+    def _write(self, text):
+        if not isinstance(text, str):
+            text = text.encode("utf-8")
+        self.stream.write(text)
+    def declare_style(self, color, fill = 1, outline = 1):
+        key = (color, fill, outline)
+        if key not in self.styles:
+            if self._in_folder:
+                raise ValueError("Shared styles must be declared before the first folder")
+            self.styles[key] = "style%d" % len(self.styles)
+            self._write('<Style id="%s">%s</Style>\n' % (self.styles[key], _style(color, fill, outline)))
+        return self.styles[key]
+    def begin_folder(self, folder_id, name, description):
+        self._in_folder = True
+        self._write('<Folder id=%s><name>%s</name><visibility>1</visibility><description>%s</description>\n' % (quoteattr(folder_id), escape(name), escape(description)))
+    def end_folder(self):
+        self._write('</Folder>\n')
+    def add_placemark(self, placemark_id, name, description, geometry, color = None, fill = 1, outline = 1):
+        kml = ['<Placemark id=%s><name>%s</name><visibility>1</visibility><description>%s</description>' % (quoteattr(placemark_id), escape(name), escape(description))]
+        if color is not None:
+            key = (color, fill, outline)
+            if key in self.styles:
+                kml.append('<styleUrl>#%s</styleUrl>' % self.styles[key])
+            else:
+                kml.append('<Style>%s</Style>' % _style(color, fill, outline))
+        kml.append(geometry_to_kml(geometry))
+        kml.append('</Placemark>\n')
+        self._write(''.join(kml))
+    def add_network_link(self, link_id, name, href, region = None):
+        """Adds a link to another KML document, which is loaded once region (if any) becomes active"""
+        if region is None:
+            region = ""
+        self._write('<NetworkLink id=%s><name>%s</name><visibility>1</visibility>%s<Link><href>%s</href><viewRefreshMode>onRegion</viewRefreshMode></Link></NetworkLink>\n' % (quoteattr(link_id), escape(name), region, escape(href)))
+    def close(self):
+        self._write('</Document></kml>\n')
+        self.stream.flush()
@@ -0,0 +1,185 @@
+# Writes a KML layer as a pyramid of tiles, so that a viewer only loads the part of the map that is on screen, at a
+# level of detail that suits the current zoom.
+#
+# The tiles form a quadtree over the extent of every placemark. Each placemark belongs to the tile (at every level)
+# that contains the center of its bounding box. A tile with at most max_placemarks placemarks (or at max_level) is a
+# leaf, and has all of them at full resolution. Any other tile has only the placemarks that are at least MIN_PIXELS
+# across when the tile is REGION_PIXELS across (at most max_placemarks of them, largest first), simplified to about a
+# pixel at that size, and NetworkLinks to its (non-empty) quadrants. Each tile's Region keeps it visible only until its
+# quadrants are active, and every tile declares only the styles that its own placemarks use. A Region's box is the
+# tile's cell extended to the bounds of all of its placemarks, so that a placemark that crosses the edge of its cell is
+# drawn for as long as any part of it is in view.
+#
+# The root tile is DIRECTORY/doc.kml, and every other tile is DIRECTORY/LEVEL_X_Y.kml. The tiles are written by a
+# pool of worker processes when there is more than one worker.
+
+import multiprocessing
+import os
+
+import shapely.wkb
+
+import kmlstream
+from metrics import Collected, METRICS
+
+REGION_PIXELS = 256
+MIN_PIXELS = 2
+MAX_PLACEMARKS = 1000
+MAX_LEVEL = 16
+
+def tile_filename(level, x, y):
+    if level == 0:
+        return "doc.kml"
+    return "%d_%d_%d.kml" % (level, x, y)
+
+class Tile(object):
+    __slots__ = ("level", "x", "y", "west", "south", "east", "north", "placemarks")
+    def __init__(self, level, x, y, west, south, east, north, placemarks):
+        self.level = level
+        self.x = x
+        self.y = y
+        self.west = west
+        self.south = south
+        self.east = east
+        self.north = north
+        self.placemarks = placemarks
+    def quadrants(self, bounds):
+        """Returns the non-empty quadrants of this tile, with each of its placemarks in the one containing its center"""
+        middle_x = (self.west + self.east) / 2.0
+        middle_y = (self.south + self.north) / 2.0
+        members = [[], [], [], []]
+        for k in self.placemarks:
+            minx, miny, maxx, maxy = bounds[k]
+            i = 1 if (minx + maxx) / 2.0 >= middle_x else 0
+            j = 1 if (miny + maxy) / 2.0 >= middle_y else 0
+            members[j * 2 + i].append(k)
+        quadrants = []
+        for q, placemarks in enumerate(members):
+            if not placemarks:
+                continue
+            i, j = q % 2, q // 2
+            west, east = (self.west, middle_x) if i == 0 else (middle_x, self.east)
+            south, north = (self.south, middle_y) if j == 0 else (middle_y, self.north)
+            quadrants.append(Tile(self.level + 1, self.x * 2 + i, self.y * 2 + j, west, south, east, north, placemarks))
+        return quadrants
+    def box(self, bounds):
+        """Returns the union of this tile's cell and the bounds of its placemarks (and so of every descendant's)"""
+        west, south, east, north = self.west, self.south, self.east, self.north
+        for k in self.placemarks:
+            minx, miny, maxx, maxy = bounds[k]
+            west = min(west, minx)
+            south = min(south, miny)
+            east = max(east, maxx)
+            north = max(north, maxy)
+        return west, south, east, north
+    def region(self, bounds, is_leaf):
+        # a tile is replaced by its quadrants once they are large enough to be active
+        min_lod_pixels = 0 if self.level == 0 else REGION_PIXELS // 2
+        max_lod_pixels = -1 if is_leaf else REGION_PIXELS
+        west, south, east, north = self.box(bounds)
+        return kmlstream.region_to_kml(west, south, east, north, min_lod_pixels, max_lod_pixels)
+    def link_region(self, bounds):
+        # the link stays loaded at every larger size, while the tile's own region decides when it is drawn
+        west, south, east, north = self.box(bounds)
+        return kmlstream.region_to_kml(west, south, east, north, REGION_PIXELS // 2, -1)
+
+def _write_tile(job):
+    path, document, region, folders, placemarks, tolerance, links = job
+    with open(path, "wb") as stream:
+        writer = kmlstream.KMLWriter(stream, document[0], document[1], document[2], region = region)
+        for folder, placemark_id, name, description, color, fill, outline, wkb in placemarks:
+            if color is not None:
+                writer.declare_style(color, fill = fill, outline = outline)
+        current_folder = None
+        for folder, placemark_id, name, description, color, fill, outline, wkb in placemarks:
+            geometry = shapely.wkb.loads(wkb)
+            if tolerance > 0:
+                with METRICS.timer("kmltiles.simplify"):
+                    geometry = geometry.simplify(tolerance, preserve_topology = True)
+                if geometry.is_empty:
+                    continue
+            if folder != current_folder:
+                if current_folder is not None:
+                    writer.end_folder()
+                writer.begin_folder(*folders[folder])
+                current_folder = folder
+            writer.add_placemark(placemark_id, name, description, geometry, color = color, fill = fill, outline = outline)
+            METRICS.count("kmltiles.placemarks")
+        if current_folder is not None:
+            writer.end_folder()
+        for link in links:
+            writer.add_network_link(*link)
+        writer.close()
+    METRICS.count("kmltiles.tiles")
+    return path
+
+class TiledKMLWriter(object):
+    """Has the same interface as kmlstream.KMLWriter, but collects the placemarks and writes them as a pyramid of tiles
+    to a directory when it is closed"""
+    def __init__(self, directory, document_id, name, description, workers = 1, max_placemarks = MAX_PLACEMARKS, max_level = MAX_LEVEL):
+        self.directory = directory
+        self.document = (document_id, name, description)
+        self.workers = workers
+        self.max_placemarks = max_placemarks
+        self.max_level = max_level
+        self.folders = []
+        self.placemarks = []
+        self.bounds = []
+    def declare_style(self, color, fill = 1, outline = 1):
+        # every tile declares its own styles
+        pass
+    def begin_folder(self, folder_id, name, description):
+        self.folders.append((folder_id, name, description))
+    def end_folder(self):
+        pass
+    def add_placemark(self, placemark_id, name, description, geometry, color = None, fill = 1, outline = 1):
+        if geometry.is_empty:
+            return
+        self.placemarks.append((len(self.folders) - 1, placemark_id, name, description, color, fill, outline, geometry.wkb))
+        self.bounds.append(geometry.bounds)
+    def _size(self, k, tile):
+        minx, miny, maxx, maxy = self.bounds[k]
+        return max((maxx - minx) / (tile.east - tile.west), (maxy - miny) / (tile.north - tile.south)) * REGION_PIXELS
+    def _jobs(self):
+        west = min(b[0] for b in self.bounds)
+        south = min(b[1] for b in self.bounds)
+        east = max(b[2] for b in self.bounds)
+        north = max(b[3] for b in self.bounds)
+        # keep the tiles from being degenerate when every placemark lines up
+        if east - west <= 0:
+            east = west + 1e-6
+        if north - south <= 0:
+            north = south + 1e-6
+        tiles = [Tile(0, 0, 0, west, south, east, north, list(range(len(self.placemarks))))]
+        while tiles:
+            tile = tiles.pop()
+            is_leaf = len(tile.placemarks) <= self.max_placemarks or tile.level >= self.max_level
+            if is_leaf:
+                shown = tile.placemarks
+                quadrants = []
+                tolerance = 0.0
+            else:
+                shown = [k for k in tile.placemarks if self._size(k, tile) >= MIN_PIXELS]
+                if len(shown) > self.max_placemarks:
+                    shown = sorted(sorted(shown, key = lambda k : self._size(k, tile), reverse = True)[:self.max_placemarks])
+                quadrants = tile.quadrants(self.bounds)
+                tolerance = max(tile.east - tile.west, tile.north - tile.south) / REGION_PIXELS
+                tiles.extend(quadrants)
+            document = ("%s %d/%d/%d" % (self.document[0], tile.level, tile.x, tile.y), self.document[1], self.document[2])
+            links = [("%d_%d_%d" % (q.level, q.x, q.y), "%d/%d/%d" % (q.level, q.x, q.y), tile_filename(q.level, q.x, q.y), q.link_region(self.bounds)) for q in quadrants]
+            yield os.path.join(self.directory, tile_filename(tile.level, tile.x, tile.y)), document, tile.region(self.bounds, is_leaf), self.folders, [self.placemarks[k] for k in shown], tolerance, links
+    def close(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if not self.placemarks:
+            _write_tile((os.path.join(self.directory, tile_filename(0, 0, 0)), self.document, None, self.folders, [], 0.0, []))
+            return
+        if self.workers > 1:
+            pool = multiprocessing.Pool(self.workers)
+            try:
+                for path, snapshot in pool.imap_unordered(Collected(_write_tile), self._jobs()):
+                    METRICS.merge(snapshot)
+            finally:
+                pool.terminate()
+        else:
+            for job in self._jobs():
+                _write_tile(job)
@@ -1,10 +1,74 @@
 from fastkml import kml
 import fastkml
-import shapely
 
+import featurecache
+import functools
+import kmlstream
+import kmltiles
+from metrics import METRICS
+import metrics
 import philly
 import zoning
 
+ZONING_COLORS = {
+    ("RSD-1", "RSD-2", "RSD-3") : (245, 240, 192),
+    ("RSA-1", "RSA-2", "RSA-3") : (244, 239, 103),
+    ("RSA-4", "RSA-5") : (240, 235, 101),
+    ("RTA-1",) : (205, 181, 78),
+    tuple("RM-%d" % i for i in range(1,5)) : (252, 184, 80),
+    ("RMX-1", "RMX-2", "RMX-3") : (230, 132, 37),
+    ("CMX-1", "CMX-2", "CMX-2.5") : (241, 102, 103),
+    ("CMX-3", "CMX-4") : (238, 33, 35),
+    ("CMX-5",) : (177, 31, 36),
+    ("CA-1", "CA-2") : (247, 161, 163),
+    ("IRMX",) : (212, 165, 120),
+    ("ICMX",) : (220, 190, 218),
+    ("I-1",) : (178, 127, 183),
+    ("I-2",) : (135, 74, 157),
+    ("I-3",) : (84, 71, 157),
+    ("I-P",) : (129, 126, 188),
+    ("SP-PO-A", "SP-PO-P") : (0, 255, 0),
+    ("SP-INS",) : (235, 232, 197),
+    ("SP-ENT",) : (235, 0, 0),
+    ("SP-STA",) : (255, 0, 0),
+}
+
+def zoning_colors():
+    """Returns the KML polygon color of every zoning class that has one"""
+    colors = {}
+    for classes, rgb in ZONING_COLORS.iteritems():
+        hexstyle = "7f%02x%02x%02x" % tuple(reversed(rgb))
+        for c in classes:
+            colors[c] = hexstyle
+    return colors
+
+def feature_placemarks(feature, colors):
+    """Yields the placemarks of a feature (whose area has already been calculated)"""
+    fzoning = feature.zoning_code()
+    if feature.old_zoning:
+        occupancies = []
+        lot_sqft = feature.lot_sqft()
+        for z in feature.old_zoning:
+            if z[0] in philly.ZONING:
+                occupancies.append(philly.ZONING[z[0]].resident_bounds(lot_sqft)[1])
+        old_zoning = feature.old_zoning_description()
+        #if occupancies:
+        #    max_occupancy = max(occupancies)
+        #    old_zoning = "%s maximum occupancy: %s" % (old_zoning, max_occupancy)
+        #    if fzoning in philly.ZONING:
+        #        old_zoning = "%s (%.2f%%)" % (old_zoning, max_occupancy / philly.ZONING[fzoning].resident_bounds(lot_sqft)[1] * 100.0)
+    else:
+        old_zoning = "N/A"
+    for poly in feature.polygons():
+        yield str(feature.objectid), fzoning, "Pre-2012 Zoning: %s" % old_zoning, colors.get(fzoning), poly
+
+def kml_placemarks(zoning_map):
+    """Yields the (id, name, description, color, polygon) of every placemark in the zoning map"""
+    colors = zoning_colors()
+    for feature in zoning.with_areas(zoning_map):
+        for placemark in feature_placemarks(feature, colors):
+            yield placemark
+
 def map_to_kml(zoning_map):
     k = kml.KML()
     ns = '{http://www.opengis.net/kml/2.2}'
@@ -12,70 +76,63 @@ def map_to_kml(zoning_map):
     k.append(d)
     f = kml.Folder(ns, 'PHL Zoning', 'Philadelphia Zoning', 'Changes to Philadelphia zoning from 2012 to 2017')
     d.append(f)
-    zoning_colors = {
-        ("RSD-1", "RSD-2", "RSD-3") : (245, 240, 192),
-        ("RSA-1", "RSA-2", "RSA-3") : (244, 239, 103),
-        ("RSA-4", "RSA-5") : (240, 235, 101),
-        ("RTA-1",) : (205, 181, 78),
-        ("RM-%d" % i for i in range(1,5)) : (252, 184, 80),
-        ("RMX-1", "RMX-2", "RMX-3") : (230, 132, 37),
-        ("CMX-1", "CMX-2", "CMX-2.5") : (241, 102, 103),
-        ("CMX-3", "CMX-4") : (238, 33, 35),
-        ("CMX-5",) : (177, 31, 36),
-        ("CA-1", "CA-2") : (247, 161, 163),
-        ("IRMX",) : (212, 165, 120),
-        ("ICMX",) : (220, 190, 218),
-        ("I-1",) : (178, 127, 183),
-        ("I-2",) : (135, 74, 157),
-        ("I-3",) : (84, 71, 157),
-        ("I-P",) : (129, 126, 188),
-        ("SP-PO-A", "SP-PO-P") : (0, 255, 0),
-        ("SP-INS",) : (235, 232, 197),
-        ("SP-ENT",) : (235, 0, 0),
-        ("SP-STA",) : (255, 0, 0),
-        }
     zoning_styles = {}
-    for classes, rgb in zoning_colors.iteritems():
-        hexstyle = "7f%02x%02x%02x" % tuple(reversed(rgb))
-        style = fastkml.styles.Style(ns=ns, styles=[fastkml.styles.PolyStyle(ns=ns, color=hexstyle, fill=1, outline=1)])
-        for c in classes:
-            zoning_styles[c] = style
-    for feature in zoning_map:
-        if feature.geometry.geom_type == "Polygon":
-            polygons = [feature.geometry]
-        else:
-            allparts = [p.buffer(0) for p in feature.geometry]
-            polygons = [shapely.ops.cascaded_union(allparts)]
-        fzoning = feature.zoning
-        while type(fzoning) == list and len(fzoning) == 1:
-            fzoning = fzoning[0]
-        fzoning = str(fzoning)
-        if feature.old_zoning:
-            occupancies = []
-            zonings = []
-            for z in feature.old_zoning:
-                zonings.append(' '.join(z))
-                if z[0] in philly.ZONING:
-                    lot_sqft = zoning.square_meters_to_square_feet(feature.area())
-                    occupancies.append(philly.ZONING[z[0]].resident_bounds(lot_sqft)[1])
-            old_zoning = " and ".join(zonings)
-            #if occupancies:
-            #    max_occupancy = max(occupancies)
-            #    old_zoning = "%s maximum occupancy: %s" % (old_zoning, max_occupancy)
-            #    if fzoning in philly.ZONING:
-            #        old_zoning = "%s (%.2f%%)" % (old_zoning, max_occupancy / philly.ZONING[fzoning].resident_bounds(lot_sqft)[1] * 100.0)
-        else:
-            old_zoning = "N/A"
-        for poly in polygons:
-            p = kml.Placemark(ns, str(feature.objectid), fzoning, "Pre-2012 Zoning: %s" % old_zoning)
-            if fzoning in zoning_styles:
-                p.append_style(zoning_styles[fzoning])
-            p.geometry = poly
-            f.append(p)
+    for placemark_id, name, description, color, poly in kml_placemarks(zoning_map):
+        p = kml.Placemark(ns, placemark_id, name, description)
+        if color is not None:
+            if color not in zoning_styles:
+                zoning_styles[color] = fastkml.styles.Style(ns=ns, styles=[fastkml.styles.PolyStyle(ns=ns, color=color, fill=1, outline=1)])
+            p.append_style(zoning_styles[color])
+        p.geometry = poly
+        f.append(p)
     return k
 
+class KMLSink(object):
+    """Writes the zoning KML placemarks of features to outstream as they are added.
+    writer_class may instead be kmltiles.TiledKMLWriter, in which case outstream is the directory of the tiles."""
+    def __init__(self, outstream, writer_class = kmlstream.KMLWriter):
+        self.colors = zoning_colors()
+        self.writer = writer_class(outstream, 'PHL Zoning Changes', 'Philadelphia Zoning Changes 2012 to 2017', 'A map of current (2017) zoning plots along with the previous (Pre-2012) classifications.')
+        for color in sorted(set(self.colors.values())):
+            self.writer.declare_style(color, fill = 1, outline = 1)
+        self.writer.begin_folder('PHL Zoning', 'Philadelphia Zoning', 'Changes to Philadelphia zoning from 2012 to 2017')
+    def add(self, feature):
+        METRICS.count("mapping.features")
+        with METRICS.timer("mapping.placemarks"):
+            placemarks = list(feature_placemarks(feature, self.colors))
+        with METRICS.timer("mapping.kml_write"):
+            for placemark_id, name, description, color, poly in placemarks:
+                self.writer.add_placemark(placemark_id, name, description, poly, color = color, fill = 1, outline = 1)
+    def close(self):
+        self.writer.end_folder()
+        self.writer.close()
+
+def write_kml(zoning_map, outstream, writer_class = kmlstream.KMLWriter):
+    """Like map_to_kml, but writes each placemark to outstream as soon as its feature is processed"""
+    sink = KMLSink(outstream, writer_class = writer_class)
+    for feature in zoning.with_areas(zoning_map):
+        sink.add(feature)
+        METRICS.maybe_export()
+    sink.close()
+
 if __name__ == "__main__":
     import sys
 
-    with open(sys.argv[1], 'r') as f:
-        print map_to_kml(zoning.ZoningMap(f)).to_string(prettyprint=True)
+    args = metrics.configure(sys.argv[1:])
+    # --tiles DIRECTORY writes a pyramid of KML tiles (see kmltiles) instead of a single KML document to stdout,
+    # using --workers processes to write the tiles
+    workers = 1
+    if "--workers" in args:
+        i = args.index("--workers")
+        workers = int(args[i + 1])
+        del args[i:i + 2]
+    outstream = sys.stdout
+    writer_class = kmlstream.KMLWriter
+    if "--tiles" in args:
+        i = args.index("--tiles")
+        outstream = args[i + 1]
+        writer_class = functools.partial(kmltiles.TiledKMLWriter, workers = workers)
+        del args[i:i + 2]
+    derived = featurecache.load(args[0], logger = sys.stderr.write)
+    with open(args[0], 'r') as f:
+        write_kml(zoning.ZoningMap(f, streaming = True, derived = derived), outstream, writer_class = writer_class)
@@ -0,0 +1,164 @@
+# Counters and timers for the hot paths of the pipeline.
+#
+# Every module (and thread) records into the module-level METRICS. The scripts accept these options:
+#   --metrics PATH           periodically (and on exit) write the metrics to PATH, as JSON if PATH ends in .json and
+#                            as CSV otherwise
+#   --metrics-interval SECS  how often the metrics file is rewritten (default 60 seconds)
+#   --profile PATH           run under cProfile and dump the statistics to PATH (readable with pstats)
+#   --sample PATH            sample the main thread's stack every 10ms and write the samples to PATH in the collapsed
+#                            format read by flame graph tools
+#
+# Work done in a process pool is only counted if the pool runs its function wrapped in Collected.
+
+import atexit
+import collections
+import cProfile
+import csv
+import json
+import os
+import signal
+import threading
+import time
+
+class Timer(object):
+    """A context manager that adds its elapsed time to one of the timers of a Metrics"""
+    __slots__ = ("metrics", "name", "start")
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.add_time(self.name, time.time() - self.start)
+        return False
+
+class Metrics(object):
+    """Counters and timers that any thread may record into"""
+    def __init__(self):
+        self.path = None
+        self.interval = 60.0
+        self.last_export = time.time()
+        self.reset()
+    def reset(self):
+        # a new lock, since a process forked while another thread held the old one would never see it released
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+        self.counters = collections.defaultdict(int)
+        self.timer_counts = collections.defaultdict(int)
+        self.timer_seconds = collections.defaultdict(float)
+    def count(self, name, increment = 1):
+        with self._lock:
+            self.counters[name] += increment
+    def add_time(self, name, seconds, count = 1):
+        with self._lock:
+            self.timer_counts[name] += count
+            self.timer_seconds[name] += seconds
+    def timer(self, name):
+        return Timer(self, name)
+    def snapshot(self):
+        with self._lock:
+            return {
+                "elapsed":time.time() - self.start_time,
+                "counters":dict(self.counters),
+                "timers":dict((name, {"count":self.timer_counts[name], "seconds":self.timer_seconds[name]}) for name in self.timer_counts)
+            }
+    def merge(self, snapshot):
+        """Adds the counters and timers of a snapshot (e.g., from a worker process) to these"""
+        with self._lock:
+            for name, value in snapshot["counters"].items():
+                self.counters[name] += value
+            for name, timer in snapshot["timers"].items():
+                self.timer_counts[name] += timer["count"]
+                self.timer_seconds[name] += timer["seconds"]
+    def export(self, path = None):
+        if path is None:
+            path = self.path
+        snapshot = self.snapshot()
+        # write to a temporary file first so the metrics file is never seen partially written
+        with open("%s.tmp" % path, "w") as f:
+            if path.endswith(".json"):
+                json.dump(snapshot, f, indent = 2, sort_keys = True)
+            else:
+                writer = csv.writer(f)
+                writer.writerow(["name", "kind", "count", "seconds"])
+                writer.writerow(["elapsed", "time", "", snapshot["elapsed"]])
+                for name, value in sorted(snapshot["counters"].items()):
+                    writer.writerow([name, "counter", value, ""])
+                for name, timer in sorted(snapshot["timers"].items()):
+                    writer.writerow([name, "timer", timer["count"], timer["seconds"]])
+        os.rename("%s.tmp" % path, path)
+        self.last_export = time.time()
+    def maybe_export(self):
+        """Exports the metrics if a metrics file was requested and it is time to rewrite it"""
+        if self.path is not None and time.time() - self.last_export >= self.interval:
+            self.export()
+
+METRICS = Metrics()
+
+class Collected(object):
+    """Wraps a (picklable) function for a process pool so that it returns a tuple of its result and the metrics that
+    were recorded while it ran, which the parent then passes to METRICS.merge"""
+    def __init__(self, function):
+        self.function = function
+    def __call__(self, arg):
+        # the worker inherited the parent's metrics (and metrics file) when it was forked
+        METRICS.path = None
+        METRICS.reset()
+        result = self.function(arg)
+        return result, METRICS.snapshot()
+
+class StackSampler(object):
+    """Periodically samples the stack of the main thread using the profiling interval timer (Unix only)"""
+    def __init__(self, path, interval = 0.01):
+        self.path = path
+        self.interval = interval
+        self.samples = collections.Counter()
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append("%s:%s" % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+            frame = frame.f_back
+        self.samples[";".join(reversed(stack))] += 1
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        with open(self.path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write("%s %d\n" % (stack, count))
+
+def _pop_option(args, name):
+    if name not in args:
+        return None
+    i = args.index(name)
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
+
+def configure(args):
+    """Removes the metrics and profiling options from the command line arguments args (in place), starts whatever
+    they request, and arranges for the results to be written on exit"""
+    path = _pop_option(args, "--metrics")
+    interval = _pop_option(args, "--metrics-interval")
+    profile_path = _pop_option(args, "--profile")
+    sample_path = _pop_option(args, "--sample")
+    if interval is not None:
+        METRICS.interval = float(interval)
+    if path is not None:
+        METRICS.path = path
+        atexit.register(METRICS.export, path)
+    if profile_path is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        def dump():
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        atexit.register(dump)
+    if sample_path is not None:
+        sampler = StackSampler(sample_path)
+        sampler.start()
+        atexit.register(sampler.stop)
+    return args
@@ -0,0 +1,84 @@
+# Writes any combination of the density, raw, and mapping outputs in a single pass over an intersected map.
+#
+# Usage: python outputs.py [--tiles] [--workers N] intersected.json [-residency OUT] [-sqft OUT] [-current-residency OUT] [-tax OUT] [-raw OUT] [-mapping OUT]
+#
+# With --tiles, every KML output is written as a pyramid of tiles (see kmltiles) in the directory OUT, by N worker
+# processes. Each feature is parsed and has its area, lot size, and display polygons calculated only once, after which it is
+# handed to every requested output in turn.
+
+import density
+import featurecache
+import functools
+import kmlstream
+import kmltiles
+import mapping
+import metrics
+from metrics import METRICS
+import progress
+import zoning
+
+MODES = ('-residency', '-sqft', '-current-residency', '-tax', '-raw', '-mapping')
+USAGE = "Usage: python outputs.py [--tiles] [--workers N] intersected.json [-residency OUT] [-sqft OUT] [-current-residency OUT] [-tax OUT] [-raw OUT] [-mapping OUT]\n"
+
+def make_sink(mode, outstream, join = None, writer_class = kmlstream.KMLWriter):
+    if mode == '-raw':
+        return density.RawSink(outstream)
+    elif mode == '-mapping':
+        return mapping.KMLSink(outstream, writer_class = writer_class)
+    elif mode in MODES:
+        return density.KMLSink(outstream, density.make_metric(mode, join = join), writer_class = writer_class)
+    raise ValueError("Unknown output mode: %s" % mode)
+
+def write_outputs(zoning_map, sinks):
+    estimator = progress.TimeEstimator(None, 0, len(zoning_map), precision = 1)
+    for feature in zoning.with_areas(zoning_map):
+        estimator.increment()
+        for sink in sinks:
+            sink.add(feature)
+        METRICS.maybe_export()
+    for sink in sinks:
+        sink.close()
+
+if __name__ == "__main__":
+    import sys
+
+    args = metrics.configure(sys.argv[1:])
+    workers = 1
+    if "--workers" in args:
+        i = args.index("--workers")
+        workers = int(args[i + 1])
+        del args[i:i + 2]
+    writer_class = kmlstream.KMLWriter
+    tiled = "--tiles" in args
+    if tiled:
+        args.remove("--tiles")
+        writer_class = functools.partial(kmltiles.TiledKMLWriter, workers = workers)
+    if len(args) % 2 != 1:
+        # the intersected map, then a path for every output mode
+        sys.stderr.write("Every output needs a mode and a path\n%s" % USAGE)
+        sys.exit(1)
+    path = args[0]
+    outputs = []
+    for i in range(1, len(args), 2):
+        if args[i] not in MODES:
+            sys.stderr.write("Unknown output mode: %s\n%s" % (args[i], USAGE))
+            sys.exit(1)
+        outputs.append((args[i], args[i + 1]))
+
+    join = None
+    if any(mode in ('-current-residency', '-tax') for mode, output_path in outputs):
+        # the property data are only loaded (and joined) once for every output that needs them
+        import properties
+        join = properties.PropertyJoin(properties.compile_data())
+
+    # tiled KML outputs are directories, which their writers create when they are closed
+    streams = [None if tiled and mode != '-raw' else open(output_path, 'wb') for mode, output_path in outputs]
+    try:
+        sinks = [make_sink(mode, output_path if stream is None else stream, join = join, writer_class = writer_class) for (mode, output_path), stream in zip(outputs, streams)]
+        derived = featurecache.load(path, logger = sys.stderr.write)
+        with open(path, 'r') as f:
+            write_outputs(zoning.ZoningMap(f, streaming = True, derived = derived), sinks)
+    finally:
+        for stream in streams:
+            if stream is not None:
+                stream.close()
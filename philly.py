@@ -6,6 +6,7 @@
 #    http://library.amlegal.com/nxt/gateway.dll/Pennsylvania/philadelphia_pa/thephiladelphiacode?f=templates$fn=default.htm$3.0$vid=amlegal:philadelphia_pa
 
 import math
+import numpy
 
 AVERAGE_PEOPLE_PER_HOUSEHOLD = 2.35
 
@@ -206,3 +207,118 @@ _add_district("I-1", [], [], GrossFloorAreaEstimator(225), ConstantHouseholdEsti
 _add_district("I-2", [], [], GrossFloorAreaEstimator(500), ConstantHouseholdEstimator(0))
 _add_district("I-3", [], [], GrossFloorAreaEstimator(500), ConstantHouseholdEstimator(0))
 _add_district("I-P", [], [], MaximumFloorsEstimator(0.0, 6), ConstantHouseholdEstimator(0))
+
+# Estimator kinds for the compiled district tables:
+SQFT_MAXIMUM_FLOORS = 0
+SQFT_GROSS_FLOOR_AREA = 1
+SQFT_R10B = 2
+SQFT_OTHER = 3
+
+HOUSEHOLDS_CONSTANT = 0
+HOUSEHOLDS_PER_LOT_AREA = 1
+HOUSEHOLDS_GROSS_FLOOR_AREA = 2
+HOUSEHOLDS_MAXIMUM_FLOORS = 3
+HOUSEHOLDS_OTHER = 4
+
+def _resolve_estimator(estimator, attribute):
+    # the equivalent-zoning estimators just defer to the corresponding estimator of the new class
+    while isinstance(estimator, (EquivalentNewZoningAreaEstimator, EquivalentNewZoningHouseholdEstimator)):
+        estimator = getattr(ZONING[estimator.new_class], attribute)
+    return estimator
+
+class DistrictTables(object):
+    """The parameters of every district's estimators compiled into flat arrays (one row per district), so that
+    estimate_maximum_sqft, estimate_maximum_households, and resident_bounds can be evaluated for whole arrays of
+    districts and lot areas at once. The results are identical to those of the corresponding ZoningDistrict methods."""
+    def __init__(self, districts):
+        self.names = tuple(sorted(districts))
+        self.rows = dict((name, row) for row, name in enumerate(self.names))
+        n = len(self.names)
+        self.sqft_kind = numpy.empty(n, dtype=numpy.int8)
+        self.open_area = numpy.zeros(n)
+        self.floors = numpy.zeros(n)
+        self.gross_floor_area = numpy.zeros(n)
+        self.household_kind = numpy.empty(n, dtype=numpy.int8)
+        self.maximum_households = numpy.zeros(n)
+        self.min_lot_area = numpy.zeros(n)
+        self.household_open_area = numpy.zeros(n)
+        self.household_floors = numpy.zeros(n)
+        self.household_gross_floor_area = numpy.zeros(n)
+        self.square_feet_per_resident = numpy.ones(n)
+        self.new_class = numpy.full(n, -1, dtype=numpy.int32)
+        self.sqft_estimators = []
+        self.household_estimators = []
+        for row, name in enumerate(self.names):
+            district = districts[name]
+            if district.new_class is not None:
+                self.new_class[row] = self.rows[district.new_class]
+            sqft = _resolve_estimator(district.sqft_estimator, "sqft_estimator")
+            self.sqft_estimators.append(sqft)
+            if isinstance(sqft, MaximumFloorsEstimator):
+                self.sqft_kind[row] = SQFT_MAXIMUM_FLOORS
+                self.open_area[row] = sqft.minimum_open_area_percentage
+                self.floors[row] = sqft.maximum_floors
+            elif isinstance(sqft, GrossFloorAreaEstimator):
+                self.sqft_kind[row] = SQFT_GROSS_FLOOR_AREA
+                self.gross_floor_area[row] = sqft.gross_floor_area
+            elif sqft is R10BSquareFootageEstimator:
+                self.sqft_kind[row] = SQFT_R10B
+            else:
+                self.sqft_kind[row] = SQFT_OTHER
+            households = _resolve_estimator(district.household_estimator, "household_estimator")
+            self.household_estimators.append(households)
+            if isinstance(households, ConstantHouseholdEstimator):
+                self.maximum_households[row] = households.maximum_households
+                if households.min_lot_area:
+                    self.household_kind[row] = HOUSEHOLDS_PER_LOT_AREA
+                    self.min_lot_area[row] = households.min_lot_area
+                else:
+                    self.household_kind[row] = HOUSEHOLDS_CONSTANT
+            elif isinstance(households, GrossFloorAreaHouseholdEstimator):
+                self.household_kind[row] = HOUSEHOLDS_GROSS_FLOOR_AREA
+                self.household_gross_floor_area[row] = households.gross_floor_area
+                self.square_feet_per_resident[row] = households.square_feet_per_resident
+            elif isinstance(households, MaximumFloorsHouseholdEstimator):
+                self.household_kind[row] = HOUSEHOLDS_MAXIMUM_FLOORS
+                self.household_open_area[row] = households.minimum_open_area_percentage
+                self.household_floors[row] = households.maximum_floors
+                self.square_feet_per_resident[row] = households.square_feet_per_resident
+            else:
+                self.household_kind[row] = HOUSEHOLDS_OTHER
+    def __len__(self):
+        return len(self.names)
+    def lookup(self, names):
+        """Returns the row of every district name, or -1 for names that are not districts"""
+        return numpy.array([self.rows.get(name, -1) for name in names], dtype=numpy.int32)
+    def _evaluate(self, rows, lot_areas, kind, other_kind, estimators, formulas):
+        rows = numpy.asarray(rows)
+        lot_areas = numpy.asarray(lot_areas, dtype=float)
+        if numpy.any(rows < 0):
+            raise KeyError("rows must be the rows of known districts")
+        kinds = kind[rows]
+        result = numpy.empty(len(rows))
+        for k, formula in formulas.items():
+            selected = kinds == k
+            if numpy.any(selected):
+                result[selected] = formula(rows[selected], lot_areas[selected])
+        for i in numpy.nonzero(kinds == other_kind)[0]:
+            result[i] = estimators[rows[i]](lot_areas[i])
+        return result
+    def estimate_maximum_sqft(self, rows, lot_areas):
+        return self._evaluate(rows, lot_areas, self.sqft_kind, SQFT_OTHER, self.sqft_estimators, {
+            SQFT_MAXIMUM_FLOORS : lambda r, a : a * (1.0 - self.open_area[r]) * self.floors[r],
+            SQFT_GROSS_FLOOR_AREA : lambda r, a : a * self.gross_floor_area[r] / 100.0,
+            SQFT_R10B : lambda r, a : numpy.maximum(numpy.trunc(a / (1440.0 + 250.0)), 1) * 1440.0 * 5.0
+        })
+    def estimate_maximum_households(self, rows, lot_areas):
+        return self._evaluate(rows, lot_areas, self.household_kind, HOUSEHOLDS_OTHER, self.household_estimators, {
+            HOUSEHOLDS_CONSTANT : lambda r, a : self.maximum_households[r],
+            HOUSEHOLDS_PER_LOT_AREA : lambda r, a : numpy.maximum(numpy.trunc(a / self.min_lot_area[r]), 1.0) * self.maximum_households[r],
+            HOUSEHOLDS_GROSS_FLOOR_AREA : lambda r, a : numpy.ceil(((a * self.household_gross_floor_area[r] / 100.0) / self.square_feet_per_resident[r]) / AVERAGE_PEOPLE_PER_HOUSEHOLD),
+            HOUSEHOLDS_MAXIMUM_FLOORS : lambda r, a : numpy.ceil(((a * (1.0 - self.household_open_area[r]) * self.household_floors[r]) / self.square_feet_per_resident[r]) / AVERAGE_PEOPLE_PER_HOUSEHOLD)
+        })
+    def resident_bounds(self, rows, lot_areas):
+        max_households = self.estimate_maximum_households(rows, lot_areas)
+        return numpy.full(len(max_households), 1 * AVERAGE_PEOPLE_PER_HOUSEHOLD), max_households * AVERAGE_PEOPLE_PER_HOUSEHOLD
+
+ZONING_TABLES = DistrictTables(ZONING)
@@ -1,7 +1,10 @@
+import collections
+import multiprocessing
 import sys
 import time
 
 class Progress(object):
+    __slots__ = ("time", "percent")
     def __init__(self, time, percent):
         self.time = time
         self.percent = percent
@@ -9,12 +12,29 @@ class Progress(object):
 def default_logger(msg):
     sys.stderr.write(msg)
     sys.stderr.flush()
-        
+
+class SharedCounter(object):
+    """A progress counter in shared memory, which worker processes add to and their parent reads.
+    It has to be given to the workers when the pool is created (e.g., as an argument to the pool's initializer)."""
+    def __init__(self):
+        self._value = multiprocessing.Value('d', 0.0)
+    def add(self, amount):
+        with self._value.get_lock():
+            self._value.value += amount
+    @property
+    def value(self):
+        return self._value.value
+
 class TimeEstimator(object):
-    def __init__(self, logger = None, start_value = 0.0, end_value = 100.0, precision = 2, interval = 3.0, window = None):
+    """Logs the percent complete and the estimated time remaining as a value approaches end_value.
+    increment() and update() are cheap enough to call in the innermost loop: they only compare the value against the
+    next whole percent (at the given precision) and count down to the next time the clock is checked, and only then
+    is anything calculated or logged. The rate used for the estimate comes from a fixed number of recent samples.
+    If shared is a SharedCounter, this estimator's progress (as a fraction of shared_weight) is also added to it
+    whenever the clock is checked, so that a parent process can report the progress of all of its workers."""
+    def __init__(self, logger = None, start_value = 0.0, end_value = 100.0, precision = 2, interval = 3.0, window = None, history = 64, shared = None, shared_weight = 1.0):
         self.value = start_value
-        self.end_value = end_value
-        self.progress = []
+        self.progress = collections.deque(maxlen = history)
         if logger is None:
             logger = default_logger
         self.logger = logger
@@ -23,36 +43,85 @@ class TimeEstimator(object):
         if window is None:
             window = interval * 4
         self.window = window
+        self.shared = shared
+        self.shared_weight = shared_weight
+        self._published = 0.0
         self.last_log_time = 0
         self.last_percent = -1
         self.start_time = time.time()
+        self._last_check_time = self.start_time
+        self._calls = 0
+        self._countdown = 1
+        self._next_value = float("-inf")
+        self.end_value = end_value
+    @property
+    def end_value(self):
+        return self._end_value
+    @end_value.setter
+    def end_value(self, end_value):
+        self._end_value = end_value
+        self._next_value = float("-inf")
     def get_time(self):
         return time.time()
     def increment(self, increment = 1):
         self.value += increment
-        self.refresh()
+        self._countdown -= 1
+        if self.value >= self._next_value or self._countdown <= 0:
+            self.refresh()
     def update(self, new_value):
         self.value = new_value
-        self.refresh()
+        self._countdown -= 1
+        if new_value >= self._next_value or self._countdown <= 0:
+            self.refresh()
     def force_next_refresh(self):
         self.last_percent = -1
+        self._next_value = float("-inf")
+    def publish(self):
+        """Adds any progress since it was last published to the shared counter"""
+        if self.shared is None:
+            return
+        fraction = min(1.0, float(self.value) / float(self.end_value)) if self.end_value else 1.0
+        published = fraction * self.shared_weight
+        if published != self._published:
+            self.shared.add(published - self._published)
+            self._published = published
+    def finish(self):
+        """Marks all of the work as done, publishing the remainder of shared_weight to the shared counter"""
+        self.value = self.end_value
+        if self.shared is not None and self._published != self.shared_weight:
+            self.shared.add(self.shared_weight - self._published)
+            self._published = self.shared_weight
+    def _reset_countdown(self, current_time):
+        # check the clock about four times per interval, based on how often the value has been changing
+        elapsed = current_time - self._last_check_time
+        calls = self._calls - self._countdown
+        if elapsed > 0:
+            self._calls = max(1, min(100000, int(calls * self.interval / (4.0 * elapsed))))
+        else:
+            self._calls = min(100000, max(1, calls) * 2)
+        self._countdown = self._calls
+        self._last_check_time = current_time
     def refresh(self):
-        raw_percent = float((self.value) * 10**(2+self.precision)) / float(self.end_value)
-        percent = float(int(raw_percent)) / 10**self.precision
-        raw_percent /= 10**self.precision
         current_time = time.time()
+        self._reset_countdown(current_time)
+        self.publish()
+        step = 10**self.precision
+        raw_percent = float((self.value) * 10**(2+self.precision)) / float(self.end_value)
+        percent = float(int(raw_percent)) / step
+        raw_percent /= step
+        self._next_value = (percent + 1.0 / step) * self.end_value / 100.0
         self.progress.append(Progress(current_time, raw_percent))
-        if percent > self.last_percent or not self.progress or current_time - self.last_log_time >= self.interval:
+        if percent > self.last_percent or current_time - self.last_log_time >= self.interval:
             self.last_log_time = current_time
             self.last_percent = percent
-            prune_index = 0
-            while len(self.progress) - prune_index > 2 and current_time - self.progress[prune_index].time > self.window:
-                prune_index += 1
-            self.progress = self.progress[prune_index:]
-            if raw_percent == 0 or len(self.progress) < 2 or self.progress[-1].percent == self.progress[0].percent:
+            first = 0
+            while len(self.progress) - first > 2 and current_time - self.progress[first].time > self.window:
+                first += 1
+            oldest = self.progress[first]
+            if raw_percent == 0 or len(self.progress) - first < 2 or self.progress[-1].percent == oldest.percent:
                 time_remaining = "????"
             else:
-                seconds_remaining = (current_time - self.progress[0].time) / (self.progress[-1].percent - self.progress[0].percent) * (100.0 - raw_percent)
+                seconds_remaining = (current_time - oldest.time) / (self.progress[-1].percent - oldest.percent) * (100.0 - raw_percent)
                 time_remaining = ""
                 if seconds_remaining >= 60**2:
                     hours = int(seconds_remaining / 60**2)
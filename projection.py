@@ -0,0 +1,159 @@
+import numpy
+import pyproj
+from shapely.geometry import GeometryCollection, LinearRing, LineString, MultiLineString, MultiPoint, MultiPolygon, Point, Polygon
+import shapely.ops
+
+WGS84 = pyproj.Proj(init='EPSG:4326')
+
+MAX_CACHED_PROJECTIONS = 4096
+
+class AlbersEqualArea(object):
+    """An Albers equal-area conic projection from WGS84 whose pyproj objects are constructed only once"""
+    def __init__(self, lat1, lat2):
+        self.lat1 = lat1
+        self.lat2 = lat2
+        self.proj = pyproj.Proj(proj='aea', lat1=lat1, lat2=lat2)
+        if hasattr(pyproj, "Transformer"):
+            # pyproj >= 2.1 can reuse the transformation pipeline between calls
+            self._transformer = pyproj.Transformer.from_proj(WGS84, self.proj)
+        else:
+            self._transformer = None
+    def transform(self, xs, ys):
+        """Reprojects arrays of longitudes and latitudes in a single call"""
+        if self._transformer is not None:
+            return self._transformer.transform(xs, ys)
+        return pyproj.transform(WGS84, self.proj, xs, ys)
+    def project(self, geometry):
+        """Reprojects every coordinate of a geometry with a single call to the transformer"""
+        if geometry.is_empty:
+            return geometry
+        elif geometry.has_z:
+            return shapely.ops.transform(self.transform, geometry)
+        sequences = [numpy.asarray(seq, dtype=float).reshape(-1, 2) for seq in _coordinate_sequences(geometry)]
+        coords = numpy.concatenate(sequences)
+        xs, ys = self.transform(coords[:,0], coords[:,1])
+        projected = numpy.column_stack((xs, ys))
+        offsets = numpy.cumsum([0] + [len(seq) for seq in sequences])
+        return _rebuild(geometry, iter([projected[offsets[k]:offsets[k+1]] for k in range(len(sequences))]))
+
+def _ring_areas(xs, ys, lengths):
+    """Calculates the signed area of every ring in the concatenated coordinate arrays.
+    This evaluates the shoelace formula in exactly the same order as GEOS, so the results are identical to shapely's."""
+    areas = numpy.zeros(len(lengths))
+    starts = numpy.cumsum(numpy.concatenate(([0], lengths[:-1]))).astype(int)
+    counts = numpy.maximum(lengths - 2, 0).astype(int)
+    rings = numpy.nonzero(counts)[0]
+    if len(rings) == 0:
+        return areas
+    ring_of_term = numpy.repeat(rings, counts[rings])
+    position = numpy.arange(len(ring_of_term)) - numpy.repeat(numpy.cumsum(counts[rings]) - counts[rings], counts[rings])
+    j = starts[ring_of_term] + 1 + position
+    terms = (xs[j] - xs[starts[ring_of_term]]) * (ys[j - 1] - ys[j + 1])
+    # GEOS sums the terms sequentially, so lay the rings out in rows (bucketed by length to limit padding)
+    # and use cumsum, which also accumulates sequentially, rather than the pairwise summation of numpy.sum
+    term_offsets = numpy.cumsum(counts[rings]) - counts[rings]
+    widths = 2 ** numpy.ceil(numpy.log2(counts[rings])).astype(int)
+    for width in numpy.unique(widths):
+        bucket = numpy.nonzero(widths == width)[0]
+        rows = numpy.zeros((len(bucket), width))
+        bucket_counts = counts[rings[bucket]]
+        row = numpy.repeat(numpy.arange(len(bucket)), bucket_counts)
+        column = numpy.arange(len(row)) - numpy.repeat(numpy.cumsum(bucket_counts) - bucket_counts, bucket_counts)
+        rows[row, column] = terms[numpy.repeat(term_offsets[bucket], bucket_counts) + column]
+        areas[rings[bucket]] = numpy.cumsum(rows, axis=1)[numpy.arange(len(bucket)), bucket_counts - 1] / 2.0
+    return areas
+
+def _polygon_tree(geometry, rings):
+    """Appends the coordinate sequences of every polygon ring in geometry to rings, returning the nesting of ring indexes"""
+    if geometry.is_empty:
+        return []
+    elif isinstance(geometry, Polygon):
+        indexes = []
+        for ring in [geometry.exterior] + list(geometry.interiors):
+            indexes.append(len(rings))
+            rings.append(ring.coords)
+        return tuple(indexes)
+    elif hasattr(geometry, "geoms"):
+        return [_polygon_tree(part, rings) for part in geometry.geoms]
+    # points and lines have no area
+    return []
+
+def _tree_area(tree, ring_areas):
+    if isinstance(tree, tuple):
+        area = abs(ring_areas[tree[0]])
+        for hole in tree[1:]:
+            area -= abs(ring_areas[hole])
+        return area
+    area = 0.0
+    for part in tree:
+        area += _tree_area(part, ring_areas)
+    return area
+
+def areas(geometries, projections):
+    """Calculates the projected area of every geometry, each in its corresponding projection.
+    Every projection's coordinates are reprojected in a single call and the ring areas are all calculated at once."""
+    trees = []
+    rings = []
+    by_projection = {}
+    for geometry, proj in zip(geometries, projections):
+        first_ring = len(rings)
+        trees.append(_polygon_tree(geometry, rings))
+        by_projection.setdefault(id(proj), (proj, []))[1].extend(range(first_ring, len(rings)))
+    if not rings:
+        return [0.0] * len(trees)
+    lengths = numpy.array([len(ring) for ring in rings])
+    offsets = numpy.concatenate(([0], numpy.cumsum(lengths)))
+    xs = numpy.empty(offsets[-1])
+    ys = numpy.empty(offsets[-1])
+    for proj, ring_indexes in by_projection.values():
+        if not ring_indexes:
+            continue
+        coords = numpy.concatenate([numpy.asarray(rings[r], dtype=float)[:,:2] for r in ring_indexes])
+        projected_xs, projected_ys = proj.transform(coords[:,0], coords[:,1])
+        destination = numpy.concatenate([numpy.arange(offsets[r], offsets[r + 1]) for r in ring_indexes])
+        xs[destination] = projected_xs
+        ys[destination] = projected_ys
+    ring_areas = _ring_areas(xs, ys, lengths).tolist()
+    return [_tree_area(tree, ring_areas) for tree in trees]
+
+_PROJECTIONS = {}
+
+def albers_equal_area(lat1, lat2):
+    key = (lat1, lat2)
+    if key not in _PROJECTIONS:
+        if len(_PROJECTIONS) >= MAX_CACHED_PROJECTIONS:
+            _PROJECTIONS.clear()
+        _PROJECTIONS[key] = AlbersEqualArea(lat1, lat2)
+    return _PROJECTIONS[key]
+
+def _coordinate_sequences(geometry):
+    if isinstance(geometry, Polygon):
+        yield geometry.exterior.coords
+        for interior in geometry.interiors:
+            yield interior.coords
+    elif isinstance(geometry, (Point, LineString, LinearRing)):
+        yield geometry.coords
+    else:
+        for part in geometry.geoms:
+            if not part.is_empty:
+                for seq in _coordinate_sequences(part):
+                    yield seq
+
+def _rebuild(geometry, sequences):
+    if geometry.is_empty:
+        return geometry
+    elif isinstance(geometry, Polygon):
+        exterior = next(sequences)
+        return Polygon(exterior, [next(sequences) for interior in geometry.interiors])
+    elif isinstance(geometry, Point):
+        return Point(next(sequences)[0])
+    elif isinstance(geometry, (LineString, LinearRing)):
+        return type(geometry)(next(sequences))
+    parts = [_rebuild(part, sequences) for part in geometry.geoms]
+    if isinstance(geometry, MultiPolygon):
+        return MultiPolygon(parts)
+    elif isinstance(geometry, MultiLineString):
+        return MultiLineString(parts)
+    elif isinstance(geometry, MultiPoint):
+        return MultiPoint(parts)
+    return GeometryCollection(parts)
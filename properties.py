@@ -1,6 +1,11 @@
 import csv
+import itertools
+import json
+import numpy
 import os
 import scipy.spatial
+import shapely.prepared
+import shapely.vectorized
 
 import philly
 
@@ -9,25 +14,6 @@ PROPERTY_DATA_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "
 class Property(object):
     def __init__(self):
         pass
-    def get_zoning(self):
-        code = self.zoning.strip()
-        if not code:
-            return None
-        elif code in philly.ZONING:
-            return philly.ZONING[code]
-        elif ord(code[-1]) >= ord('0') and ord(code[-1]) <= ord('9'):
-            code = "%s-%d" % (code[:-1], int(code[-1]))
-            if code in philly.ZONING:
-                return philly.ZONING[code]
-        return None
-    def residential_capacity(self):
-        zoning = self.get_zoning()
-        if zoning is None:
-            return 1.0
-        max_residents = zoning.resident_bounds(float(self.total_area))[1]
-        if max_residents == 0:
-            return 1.0
-        return min(1.0, (float(self.total_livable_area) / 450.0) / max_residents)
 
 def load_opm_property_data(path = None):
     if path is None:
@@ -50,29 +36,169 @@ def field_to_float(obj, field_name):
     except ValueError:
         setattr(obj, field_name, 0.0)
             
-def compile_data():
-    points = []
-    data = []
-    for p in load_opm_property_data():
-        try:
-            points.append((float(p.lat), float(p.lng)))
-        except ValueError:
-            pass
-        for field in ("market_value", "total_livable_area", "taxable_building", "taxable_land"):
-            field_to_float(p, field)
-        data.append(p)
-    kdtree = scipy.spatial.KDTree(points)
-    return points, data, kdtree    
-            
+VALUE_FIELDS = ("market_value", "total_livable_area", "taxable_building", "taxable_land")
+COLUMNS = ("lat", "lng") + VALUE_FIELDS
+CACHE_VERSION = 1
+
+def cache_path(path):
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, ".%s.npy" % filename)
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
+
+class PropertyColumns(object):
+    """The compiled property data as one typed column per field.
+    Indexing it returns a Property with just those fields, in the same order as the compiled points."""
+    def __init__(self, table):
+        self.table = table
+    def column(self, field_name):
+        return self.table[field_name]
+    def __len__(self):
+        return len(self.table)
+    def __getitem__(self, key):
+        if key < 0 or key >= len(self):
+            raise IndexError(key)
+        p = Property()
+        for field in COLUMNS:
+            setattr(p, field, float(self.table[field][key]))
+        return p
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def load_columns(path = None):
+    """Reads only the columns that are needed from the property CSV into a structured array.
+    Properties without a location are skipped."""
+    if path is None:
+        path = PROPERTY_DATA_FILE
+    columns = tuple([] for field in COLUMNS)
+    with open(path, "rb") as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader)
+        indexes = [header.index(field) for field in COLUMNS]
+        for row in reader:
+            try:
+                lat, lng = float(row[indexes[0]]), float(row[indexes[1]])
+            except ValueError:
+                continue
+            columns[0].append(lat)
+            columns[1].append(lng)
+            for column, i in zip(columns[2:], indexes[2:]):
+                column.append(_to_float(row[i]))
+    table = numpy.empty(len(columns[0]), dtype=[(field, numpy.float64) for field in COLUMNS])
+    for field, column in zip(COLUMNS, columns):
+        table[field] = column
+    return table
+
+def _cache_key(path):
+    stat = os.stat(path)
+    return {"version":CACHE_VERSION, "size":stat.st_size, "mtime":stat.st_mtime}
+
+def load_cached_columns(path = None):
+    """Like load_columns, but memory-maps the columns from a cache file next to the CSV if the CSV is unchanged
+    since the cache was written, and otherwise rewrites the cache"""
+    if path is None:
+        path = PROPERTY_DATA_FILE
+    cache = cache_path(path)
+    key = _cache_key(path)
+    try:
+        with open("%s.key" % cache, "r") as f:
+            if json.load(f) == key:
+                return numpy.load(cache, mmap_mode="r")
+    except (IOError, ValueError):
+        pass
+    table = load_columns(path)
+    try:
+        # write to temporary files first so a concurrent run never maps a partially written cache
+        with open("%s.tmp" % cache, "wb") as f:
+            numpy.save(f, table)
+        with open("%s.key.tmp" % cache, "w") as f:
+            json.dump(key, f)
+        os.rename("%s.tmp" % cache, cache)
+        os.rename("%s.key.tmp" % cache, "%s.key" % cache)
+    except (IOError, OSError):
+        # e.g., the data directory is read-only
+        pass
+    return table
+
+class LazyKDTree(object):
+    """A scipy.spatial.cKDTree of the points that is only built when it is first used, since PropertyJoin never
+    needs one"""
+    def __init__(self, points):
+        self.points = points
+        self._tree = None
+    def __getattr__(self, name):
+        if self._tree is None:
+            self._tree = scipy.spatial.cKDTree(self.points)
+        return getattr(self._tree, name)
+
+def compile_data(path = None, cache = True):
+    if cache:
+        table = load_cached_columns(path)
+    else:
+        table = load_columns(path)
+    points = numpy.column_stack((table["lat"], table["lng"]))
+    return points, PropertyColumns(table), LazyKDTree(points)
+
+JOIN_FIELDS = ("market_value", "total_livable_area", "taxable_building")
+
+class PropertyJoin(object):
+    """A spatial join of property points to the zoning features that contain them.
+    The points are sorted by longitude so the candidates for a feature are a single slice, and are then tested
+    against the feature's prepared geometry all at once."""
+    # identifies the join that a feature's cached totals came from
+    _keys = itertools.count()
+    def __init__(self, compiled_data, fields = JOIN_FIELDS):
+        points, data, kdtree = compiled_data
+        self.key = next(PropertyJoin._keys)
+        self.fields = fields
+        points = numpy.array(points, dtype=float).reshape(-1, 2)
+        self.order = numpy.argsort(points[:,1], kind="mergesort")
+        self.lats = points[self.order,0]
+        self.lngs = points[self.order,1]
+        if hasattr(data, "column"):
+            self.values = numpy.column_stack([numpy.asarray(data.column(field))[self.order] for field in fields]).reshape(-1, len(fields))
+        else:
+            self.values = numpy.array([[getattr(data[i], field) for field in fields] for i in self.order], dtype=float).reshape(-1, len(fields))
+    def _contained(self, geometry):
+        """Returns the sorted positions (in longitude order) of every point contained in geometry"""
+        if geometry.is_empty:
+            return numpy.array([], dtype=int)
+        min_lng, min_lat, max_lng, max_lat = geometry.bounds
+        start = numpy.searchsorted(self.lngs, min_lng, side="left")
+        end = numpy.searchsorted(self.lngs, max_lng, side="right")
+        lats = self.lats[start:end]
+        candidates = numpy.nonzero((lats >= min_lat) & (lats <= max_lat))[0] + start
+        if len(candidates) == 0:
+            return candidates
+        return candidates[shapely.vectorized.contains(shapely.prepared.prep(geometry), self.lngs[candidates], self.lats[candidates])]
+    def find_contained_points(self, feature):
+        """Returns the indexes (into the compiled points) of every property contained in the feature"""
+        return sorted(self.order[self._contained(feature.geometry)].tolist())
+    def contained_totals(self, feature):
+        """Returns a tuple of the sums of each of the join fields over the properties contained in the feature.
+        The totals are cached on the feature, so every output that needs them shares a single calculation."""
+        if feature._property_totals is None or feature._property_totals[0] != self.key:
+            feature._property_totals = (self.key, tuple(self.values[self._contained(feature.geometry)].sum(axis=0).tolist()))
+        return feature._property_totals[1]
+    def totals(self, features):
+        return [self.contained_totals(feature) for feature in features]
+
 if __name__ == "__main__":
-    points, data, kdtree = compile_data()
+    join = PropertyJoin(compile_data())
 
     import sys
 
+    import featurecache
     import zoning
 
+    derived = featurecache.load(sys.argv[1], logger = sys.stderr.write)
     with open(sys.argv[1], 'r') as f:
-        zmap = zoning.ZoningMap(f)
+        zmap = zoning.ZoningMap(f, streaming = True, derived = derived)
         for feature in zmap:
             fzoning = feature.zoning
             while type(fzoning) == list and len(fzoning) == 1:
@@ -80,11 +206,7 @@ if __name__ == "__main__":
             fzoning = str(fzoning)
             if fzoning not in philly.ZONING:
                 continue
-            feature_value = 0.0
-            feature_livable_area = 0.0
-            for i in feature.find_contained_points(points, kdtree):
-                feature_value += data[i].market_value
-                feature_livable_area += data[i].total_livable_area
+            feature_value, feature_livable_area, taxable_building = join.contained_totals(feature)
             bound = philly.ZONING[fzoning].resident_bounds(zoning.square_meters_to_square_feet(feature.area()))[1]
             if bound == 0:
                 bound = 1.0
@@ -1,3 +1,6 @@
+import numpy
+from shapely.geometry import Point
+
 MFL_STATIONS = (
     (39.962175, -75.259561, "69th Street"),
     (39.964430, -75.252266, "Millbourne"),
@@ -73,3 +76,60 @@ UNDERGROUND_TROLLEY_STATIONS = (
 )
 
 PHILLY_RAPID_TRANSIT = MFL_STATIONS + BSL_STATIONS + PATCO_STATIONS + UNDERGROUND_TROLLEY_STATIONS
+
+class StationIndex(object):
+    """Answers distance queries from zoning features to a fixed set of stations.
+    The stations are reprojected into a feature's equal-area projection in a single call, and each station's
+    distance to the feature's bounding box (which can never exceed its distance to the feature itself) is used
+    to skip the exact distance calculation for every station that cannot be among the results."""
+    def __init__(self, stations):
+        self.stations = tuple(stations)
+        self.lats = numpy.array([station[0] for station in self.stations], dtype=float)
+        self.lons = numpy.array([station[1] for station in self.stations], dtype=float)
+    def __len__(self):
+        return len(self.stations)
+    def _candidates(self, feature):
+        """Returns the projected station coordinates, their lower-bound distances to the feature, and the station
+        indexes in increasing order of that bound"""
+        xs, ys = feature.projection().transform(self.lons, self.lats)
+        min_x, min_y, max_x, max_y = feature.projected().bounds
+        dx = numpy.maximum(numpy.maximum(min_x - xs, xs - max_x), 0.0)
+        dy = numpy.maximum(numpy.maximum(min_y - ys, ys - max_y), 0.0)
+        bounds = numpy.hypot(dx, dy)
+        return xs, ys, bounds, numpy.argsort(bounds, kind="mergesort")
+    def k_nearest(self, feature, k):
+        """Returns a list of up to k (distance in meters, station) tuples for the stations closest to the feature"""
+        if k <= 0 or feature.geometry.is_empty:
+            return []
+        projected = feature.projected()
+        xs, ys, bounds, order = self._candidates(feature)
+        nearest = []
+        for i in order:
+            if len(nearest) >= k and bounds[i] > nearest[-1][0]:
+                break
+            nearest.append((projected.distance(Point(xs[i], ys[i])), i))
+            nearest.sort()
+            del nearest[k:]
+        return [(distance, self.stations[i]) for distance, i in nearest]
+    def nearest(self, feature):
+        """Returns the (distance in meters, station) of the station closest to the feature"""
+        nearest = self.k_nearest(feature, 1)
+        if not nearest:
+            return None, None
+        return nearest[0]
+    def within(self, feature, radius):
+        """Returns a list of the (distance in meters, station) tuples, closest first, of every station within radius meters of the feature"""
+        if feature.geometry.is_empty:
+            return []
+        projected = feature.projected()
+        xs, ys, bounds, order = self._candidates(feature)
+        found = []
+        for i in order:
+            if bounds[i] > radius:
+                break
+            distance = projected.distance(Point(xs[i], ys[i]))
+            if distance <= radius:
+                found.append((distance, i))
+        return [(distance, self.stations[i]) for distance, i in sorted(found)]
+
+PHILLY_RAPID_TRANSIT_INDEX = StationIndex(PHILLY_RAPID_TRANSIT)
@@ -0,0 +1,66 @@
+import math
+
+def is_empty_bounds(bounds):
+    # shapely returns an empty tuple (or NaNs, in newer versions) for the bounds of an empty geometry
+    return not bounds or bounds[0] != bounds[0]
+
+def bounds_intersect(b1, b2):
+    return b1[0] <= b2[2] and b2[0] <= b1[2] and b1[1] <= b2[3] and b2[1] <= b1[3]
+
+class GridIndex(object):
+    """A dynamic bounding-box index that buckets keys into a uniform grid of square cells.
+    Unlike shapely's STRtree, keys can be inserted and removed after the index is built."""
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self._cells = {}
+        self._bounds = {}
+    def _cells_for(self, bounds):
+        minx, miny, maxx, maxy = bounds
+        for cx in range(int(math.floor(minx / self.cell_size)), int(math.floor(maxx / self.cell_size)) + 1):
+            for cy in range(int(math.floor(miny / self.cell_size)), int(math.floor(maxy / self.cell_size)) + 1):
+                yield (cx, cy)
+    def __len__(self):
+        return len(self._bounds)
+    def __contains__(self, key):
+        return key in self._bounds
+    def insert(self, key, bounds):
+        if key in self._bounds:
+            self.remove(key)
+        if is_empty_bounds(bounds):
+            # empty geometries have no bounds and can never intersect anything
+            return
+        self._bounds[key] = bounds
+        for cell in self._cells_for(bounds):
+            if cell in self._cells:
+                self._cells[cell].add(key)
+            else:
+                self._cells[cell] = set([key])
+    def remove(self, key):
+        if key not in self._bounds:
+            return
+        for cell in self._cells_for(self._bounds.pop(key)):
+            self._cells[cell].discard(key)
+            if not self._cells[cell]:
+                del self._cells[cell]
+    def query(self, bounds):
+        """Returns the sorted list of keys whose bounding boxes overlap `bounds`"""
+        if is_empty_bounds(bounds):
+            return []
+        candidates = set()
+        for cell in self._cells_for(bounds):
+            if cell in self._cells:
+                candidates.update(self._cells[cell])
+        return sorted(key for key in candidates if bounds_intersect(self._bounds[key], bounds))
+
+def estimate_cell_size(bounds_list, default = 0.01):
+    """Picks a cell size on the order of the average bounding box dimension"""
+    total = 0.0
+    count = 0
+    for bounds in bounds_list:
+        if is_empty_bounds(bounds):
+            continue
+        total += max(bounds[2] - bounds[0], bounds[3] - bounds[1])
+        count += 1
+    if count == 0 or total <= 0.0:
+        return default
+    return total / count
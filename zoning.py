@@ -1,9 +1,19 @@
-import functools
+import array
+import collections
 import json
 import math
-import pyproj
+import time
 from shapely.geometry import mapping, MultiPolygon, Point, Polygon, shape
 import shapely.ops
+import shapely.wkb
+
+import columnar
+import featurestream
+import geojsonstream
+from metrics import METRICS
+import projection
+import septa
+import spatialindex
 
 def square_meters_to_acres(m2):
     return m2 * 0.000247105
@@ -12,6 +22,7 @@ def square_meters_to_square_feet(m2):
     return m2 * 10.7639
 
 class ZoningFeature(object):
+    __slots__ = ("objectid", "zoning", "old_zoning", "_geometry", "_geojson_geometry", "_wkb_geometry", "_area", "_projected", "_polygons", "_transit_distance", "_property_totals")
     def __init__(self, objectid, zoning, geometry, old_zoning = None):
         self.objectid = objectid
         self.zoning = zoning
@@ -20,51 +31,89 @@ class ZoningFeature(object):
         self.old_zoning = old_zoning
         self.geometry = geometry
         self._area = None
+        self._projected = None
+        self._polygons = None
+        self._transit_distance = None
+        # the totals of the properties contained in this feature, cached by properties.PropertyJoin
+        self._property_totals = None
+    @property
+    def geometry(self):
+        # features that are parsed from GeoJSON (or read from a FeatureStore) only construct their geometry when it is first needed
+        if self._geometry is None:
+            if self._geojson_geometry is not None:
+                self._geometry = shape(self._geojson_geometry)
+            elif self._wkb_geometry is not None:
+                self._geometry = shapely.wkb.loads(self._wkb_geometry)
+            self._geojson_geometry = None
+            self._wkb_geometry = None
+        return self._geometry
+    @geometry.setter
+    def geometry(self, geometry):
+        self._geometry = geometry
+        self._geojson_geometry = None
+        self._wkb_geometry = None
+    def wkb(self):
+        """Returns this feature's geometry as WKB, without constructing the geometry if it is already stored that way"""
+        if self._geometry is None and self._wkb_geometry is not None:
+            return self._wkb_geometry
+        return self.geometry.wkb
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in ZoningFeature.__slots__)
+    def __setstate__(self, state):
+        for slot, value in zip(ZoningFeature.__slots__, state):
+            setattr(self, slot, value)
+    def projection(self):
+        """Returns the equal-area projection used for this zoning feature's measurements"""
+        bounds = self.geometry.bounds
+        return projection.albers_equal_area(bounds[1], bounds[3])
+    def projected(self):
+        """Returns this zoning feature's geometry in its equal-area projection, which is only calculated once"""
+        if self._projected is None:
+            with METRICS.timer("zoning.reprojection"):
+                self._projected = self.projection().project(self.geometry)
+        return self._projected
     def area(self):
         """Calculates the area of this zoning feature in square meters"""
-        if self.geometry.is_empty:
-            return 0.0
-        elif self._area is None:
-            geom_aea = shapely.ops.transform(
-                functools.partial(
-                    pyproj.transform,
-                    pyproj.Proj(init='EPSG:4326'),
-                    pyproj.Proj(
-                        proj='aea',
-                        lat1=self.geometry.bounds[1],
-                        lat2=self.geometry.bounds[3])),
-                self.geometry)
-            self._area = geom_aea.area
+        if self._area is None:
+            if self.geometry.is_empty:
+                return 0.0
+            self._area = self.projected().area
         return self._area
+    def lot_sqft(self):
+        return square_meters_to_square_feet(self.area())
+    def zoning_code(self):
+        """Returns the current zoning code as a string, unwrapping any singleton lists"""
+        fzoning = self.zoning
+        while type(fzoning) == list and len(fzoning) == 1:
+            fzoning = fzoning[0]
+        return str(fzoning)
+    def old_zoning_description(self):
+        return " and ".join(' '.join(z) for z in self.old_zoning)
+    def polygons(self):
+        """Returns this feature's geometry as a list of polygons for display, which is only calculated once"""
+        if self._polygons is None:
+            if self.geometry.geom_type == "Polygon":
+                self._polygons = [self.geometry]
+            else:
+                allparts = [p.buffer(0) for p in self.geometry]
+                self._polygons = [shapely.ops.cascaded_union(allparts)]
+        return self._polygons
+    def transit_distance(self):
+        """Returns the distance in meters from this zoning feature to the closest rapid transit station"""
+        if self._transit_distance is None:
+            self._transit_distance = septa.PHILLY_RAPID_TRANSIT_INDEX.nearest(self)[0]
+        return self._transit_distance
     def find_contained_points(self, points, kd_tree):
         for i in kd_tree.query_ball_point((self.geometry.bounds[1], self.geometry.bounds[0]), math.sqrt((self.geometry.bounds[3] - self.geometry.bounds[1])**2 + (self.geometry.bounds[2] - self.geometry.bounds[0])**2)):
             if self.geometry.contains(Point(points[i][1], points[i][0])):
                 yield i
     def diameter(self):
-        proj = pyproj.Proj(
-                    proj='aea',
-                    lat1=self.geometry.bounds[1],
-                    lat2=self.geometry.bounds[3])
-        transform = functools.partial(
-                pyproj.transform,
-                pyproj.Proj(init='EPSG:4326'),
-                proj)
-        p1_aea = shapely.ops.transform(transform, Point(self.geometry.bounds[0], self.geometry.bounds[1]))
-        p2_aea = shapely.ops.transform(transform, Point(self.geometry.bounds[2], self.geometry.bounds[3]))
-        return p1_aea.distance(p2_aea)
+        xs, ys = self.projection().transform([self.geometry.bounds[0], self.geometry.bounds[2]], [self.geometry.bounds[1], self.geometry.bounds[3]])
+        return Point(xs[0], ys[0]).distance(Point(xs[1], ys[1]))
     def distance_to(self, lat, lon):
-        proj = pyproj.Proj(
-                    proj='aea',
-                    lat1=self.geometry.bounds[1],
-                    lat2=self.geometry.bounds[3])
-        transform = functools.partial(
-                pyproj.transform,
-                pyproj.Proj(init='EPSG:4326'),
-                proj)
-        geom_aea = shapely.ops.transform(transform, self.geometry)
-        point_aea = shapely.ops.transform(transform, Point(lon, lat))
-        return geom_aea.distance(point_aea)
-    def to_geo(self):
+        x, y = self.projection().transform(lon, lat)
+        return self.projected().distance(Point(x, y))
+    def to_geo(self, include_geometry = True):
         properties = {
             "OBJECTID":self.objectid,
         }
@@ -77,11 +126,24 @@ class ZoningFeature(object):
         return {
             "type":"Feature",
             "properties":properties,
-            "geometry":mapping(self.geometry)
+            "geometry":mapping(self.geometry) if include_geometry else None
             }
 
-def parse_feature(geojson):
-    properties = geojson["properties"]
+def calculate_areas(features):
+    """Calculates the areas of many zoning features in a single pass, filling in each feature's area cache.
+    Returns the list of areas in square meters."""
+    features = list(features)
+    pending = [feature for feature in features if feature._area is None and not feature.geometry.is_empty]
+    if pending:
+        start = time.time()
+        areas = projection.areas([feature.geometry for feature in pending], [feature.projection() for feature in pending])
+        METRICS.add_time("zoning.reprojection", time.time() - start, count = len(pending))
+        for feature, area in zip(pending, areas):
+            feature._area = area
+    return [feature.area() for feature in features]
+
+def parse_properties(properties):
+    """Returns a feature without a geometry for the properties of a GeoJSON feature"""
     if "LONG_CODE" in properties:
         zoning = properties["LONG_CODE"]
     else:
@@ -90,40 +152,246 @@ def parse_feature(geojson):
         old_zoning = properties["OLD_ZONING"]
     else:
         old_zoning = None
-    return ZoningFeature(properties["OBJECTID"], [zoning], shape(geojson["geometry"]), old_zoning)
+    return ZoningFeature(properties["OBJECTID"], [zoning], None, old_zoning)
+
+def parse_feature(geojson):
+    feature = parse_properties(geojson["properties"])
+    feature._geojson_geometry = geojson["geometry"]
+    return feature
+
+def with_areas(features, batch_size = 4096):
+    """Yields every feature with its area already calculated, calculating the areas of a whole batch at a time"""
+    batch = []
+    for feature in features:
+        batch.append(feature)
+        if len(batch) >= batch_size:
+            calculate_areas(batch)
+            for f in batch:
+                yield f
+            batch = []
+    calculate_areas(batch)
+    for f in batch:
+        yield f
+
+def feature_from_geo(geojson):
+    """The inverse of ZoningFeature.to_geo()"""
+    properties = geojson["properties"]
+    if "LONG_CODE" in properties:
+        zoning = properties["LONG_CODE"]
+    else:
+        zoning = (properties["CODE"], properties["CATEGORY"])
+    return ZoningFeature(properties["OBJECTID"], zoning, shape(geojson["geometry"]), properties.get("OLD_ZONING"))
 
 class ZoningMap(object):
-    def __init__(self, stream):
-        self.json = json.load(stream)
+    def __init__(self, stream, streaming = False, derived = None):
+        """If streaming is True, the GeoJSON document is never loaded as a whole: features are parsed from the
+        (memory-mapped) file as they are requested, and are not retained by the map.
+        derived is an optional featurecache.DerivedFeatures with previously calculated values for the features.
+        The stream may also be a columnar map (see columnar), which is always read as though streaming."""
+        self.streaming = streaming
+        self.derived = derived
+        self.columnar = columnar.is_columnar(stream)
+        if self.columnar:
+            self.streaming = True
+            self.json = None
+            self._stream = columnar.ColumnarReader(stream)
+        elif streaming:
+            self.json = None
+            self._stream = featurestream.FeatureStream(stream)
+        else:
+            self.json = json.load(stream)
         self._features = []
     def save(self, outstream):
-        json.dump(self.json, outstream)
+        if self.streaming:
+            outstream.write('{"type": "FeatureCollection", "features": [')
+            for i in range(len(self)):
+                if i > 0:
+                    outstream.write(", ")
+                raw = self.raw(i)
+                if not isinstance(raw, str):
+                    raw = raw.decode("utf-8")
+                outstream.write(raw)
+            outstream.write("]}")
+        else:
+            json.dump(self.json, outstream)
     def __len__(self):
+        if self.streaming:
+            return len(self._stream)
         return len(self.json["features"])
+    def raw(self, key):
+        """Returns the GeoJSON text of a feature, without parsing it when streaming"""
+        if self.streaming:
+            return self._stream.raw(key)
+        return json.dumps(self.json["features"][key])
     def __getitem__(self, key):
         if key < 0 or key >= len(self):
             return None
+        elif self.streaming:
+            return self._parse(key, self._stream[key])
         while key >= len(self._features):
-            self._features.append(parse_feature(self.json["features"][key]))
+            self._features.append(self._parse(len(self._features), self.json["features"][len(self._features)]))
         return self._features[key]
+    def _parse(self, key, geojson):
+        if self.columnar:
+            # the columnar reader returns the properties and the WKB geometry of the feature
+            properties, wkb = geojson
+            feature = parse_properties(properties)
+            feature._wkb_geometry = wkb
+        else:
+            feature = parse_feature(geojson)
+        if self.derived is not None:
+            self.derived.apply(key, feature)
+        return feature
     def __iter__(self):
-        for i in range(len(self)):
-            yield self[i]
+        if self.streaming:
+            for key, geojson in enumerate(self._stream):
+                yield self._parse(key, geojson)
+        else:
+            for i in range(len(self)):
+                yield self[i]
+    def areas(self):
+        """Returns the area of every feature in square meters, calculating them all at once"""
+        return calculate_areas(self)
+
+class FeatureStore(object):
+    """A compact store of zoning features. Zoning values are interned, each feature's old zoning is stored as a single
+    integer, and geometries are kept as WKB until a feature is requested again. Every request returns a new
+    ZoningFeature (whose geometry is only constructed when it is first needed), so a modified feature has to be stored
+    again. Interned values are shared between the features that are returned, and must not be modified in place."""
+    def __init__(self):
+        self._values = []
+        self._value_ids = {}
+        self._combinations = []
+        self._combination_ids = {}
+        self.objectids = []
+        self.zoning = array.array('i')
+        self.old_zoning = array.array('i')
+        self.geometries = []
+        self.areas = array.array('d')
+    def _intern(self, value):
+        # repr distinguishes tuples from lists, which the features treat differently
+        key = repr(value)
+        if key not in self._value_ids:
+            self._value_ids[key] = len(self._values)
+            self._values.append(value)
+        return self._value_ids[key]
+    def _intern_combination(self, values):
+        combination = tuple(self._intern(value) for value in values)
+        if combination not in self._combination_ids:
+            self._combination_ids[combination] = len(self._combinations)
+            self._combinations.append(combination)
+        return self._combination_ids[combination]
+    def _encode(self, feature):
+        if feature._area is None:
+            area = float("nan")
+        else:
+            area = feature._area
+        return feature.objectid, self._intern(feature.zoning), self._intern_combination(feature.old_zoning), feature.wkb(), area
+    def append(self, feature):
+        objectid, zoning, old_zoning, geometry, area = self._encode(feature)
+        self.objectids.append(objectid)
+        self.zoning.append(zoning)
+        self.old_zoning.append(old_zoning)
+        self.geometries.append(geometry)
+        self.areas.append(area)
+    def __setitem__(self, key, feature):
+        self.objectids[key], self.zoning[key], self.old_zoning[key], self.geometries[key], self.areas[key] = self._encode(feature)
+    def set_area(self, key, area):
+        self.areas[key] = area
+    def copy(self):
+        """Returns a copy of the store that later changes to this one do not affect.
+        The interned values are shared, since they are only ever added to."""
+        store = FeatureStore()
+        store._values = self._values
+        store._value_ids = self._value_ids
+        store._combinations = self._combinations
+        store._combination_ids = self._combination_ids
+        store.objectids = self.objectids[:]
+        store.zoning = self.zoning[:]
+        store.old_zoning = self.old_zoning[:]
+        store.geometries = self.geometries[:]
+        store.areas = self.areas[:]
+        return store
+    def __len__(self):
+        return len(self.objectids)
+    def __getitem__(self, key):
+        feature = ZoningFeature(self.objectids[key], self._values[self.zoning[key]], None, [self._values[v] for v in self._combinations[self.old_zoning[key]]])
+        feature._wkb_geometry = self.geometries[key]
+        if not math.isnan(self.areas[key]):
+            feature._area = self.areas[key]
+        return feature
 
 class ModifiableMap(object):
-    def __init__(self, zmap):
+    def __init__(self, zmap, spatial_index = False, compact = False, recent_size = 256):
+        """If compact is True, the features are kept in a FeatureStore, and only the recent_size most recently used
+        features are kept as objects"""
         self.zmap = zmap
         self._feature_iter = iter(zmap)
         self._cache = []
         self._appended = []
-    def save(self, outstream):
-        features = [feature.to_geo() for feature in self]
-        json.dump({"type":"FeatureCollection","features":features}, outstream)
+        self._num_appended = 0
+        self.index = None
+        if compact:
+            self._store = FeatureStore()
+        else:
+            self._store = None
+        self._recent = collections.OrderedDict()
+        self._recent_size = recent_size
+        if spatial_index:
+            self.build_index()
+    def build_index(self, cell_size = None):
+        """Builds a bounding-box index over every feature in the map, which is then kept up to date as features are set and appended"""
+        # the bounds are collected in a single pass, since a compact map decodes a feature's geometry every time it is requested
+        all_bounds = [feature.geometry.bounds for feature in self]
+        if cell_size is None:
+            cell_size = spatialindex.estimate_cell_size(all_bounds)
+        self.index = spatialindex.GridIndex(cell_size)
+        for i, bounds in enumerate(all_bounds):
+            self.index.insert(i, bounds)
+    def intersecting(self, bounds):
+        """Returns the sorted indexes of all features whose bounding boxes overlap `bounds`"""
+        if self.index is None:
+            return [i for i, feature in enumerate(self) if not spatialindex.is_empty_bounds(feature.geometry.bounds) and spatialindex.bounds_intersect(feature.geometry.bounds, bounds)]
+        return self.index.query(bounds)
+    def save(self, outstream, precision = None, fast = False):
+        """Writes the map as GeoJSON one feature at a time (see geojsonstream)"""
+        geojsonstream.write_feature_collection(self, outstream, precision = precision, fast = fast)
+    def save_columnar(self, outstream):
+        """Writes the map in the columnar format (see columnar)"""
+        columnar.write_features(self, outstream)
+    def snapshot(self):
+        """Returns a copy of the map that later changes to it do not affect, e.g., so that it can be saved by
+        another thread. Features are shared rather than copied, since they are replaced rather than modified."""
+        snapshot = ModifiableMap([])
+        if self._store is not None:
+            self._fill_store(len(self.zmap) - 1)
+            snapshot._store = self._store.copy()
+            snapshot._num_appended = len(snapshot._store)
+        else:
+            snapshot._appended = list(self)
+            snapshot._num_appended = len(snapshot._appended)
+        return snapshot
     def __len__(self):
-        return len(self.zmap) + len(self._appended)
+        return len(self.zmap) + self._num_appended
+    def _fill_store(self, key):
+        while key >= len(self._store):
+            self._store.append(next(self._feature_iter))
+    def _use(self, key, feature):
+        self._recent[key] = feature
+        if len(self._recent) > self._recent_size:
+            evicted_key, evicted = self._recent.popitem(last = False)
+            if evicted._area is not None:
+                self._store.set_area(evicted_key, evicted._area)
     def __getitem__(self, key):
         if key < 0 or key >= len(self):
             return None
+        elif self._store is not None:
+            feature = self._recent.pop(key, None)
+            if feature is None:
+                self._fill_store(key)
+                feature = self._store[key]
+            self._use(key, feature)
+            return feature
         elif key < len(self.zmap):
             while key >= len(self._cache):
                 self._cache.append(next(self._feature_iter))
@@ -133,13 +401,32 @@ class ModifiableMap(object):
     def __setitem__(self, key, value):
         old_val = self[key]
         if old_val is not None:
-            if key < len(self.zmap):
+            if self._store is not None:
+                self._store[key] = value
+                self._recent.pop(key)
+                self._use(key, value)
+            elif key < len(self.zmap):
                 self._cache[key] = value
             else:
                 self._appended[key - len(self.zmap)] = value
+            if self.index is not None:
+                self.index.insert(key, value.geometry.bounds)
         return old_val
     def append(self, feature):
-        self._appended.append(feature)
+        if self._store is not None:
+            # the store is indexed the same as the map, so every original feature has to be stored first
+            self._fill_store(len(self.zmap) - 1)
+            self._store.append(feature)
+            self._num_appended += 1
+            self._use(len(self) - 1, feature)
+        else:
+            self._appended.append(feature)
+            self._num_appended += 1
+        if self.index is not None:
+            self.index.insert(len(self) - 1, feature.geometry.bounds)
     def __iter__(self):
         for i in range(len(self)):
             yield self[i]
+    def areas(self):
+        """Returns the area of every feature in square meters, calculating them all at once"""
+        return calculate_areas(self)